@@ -1,9 +1,11 @@
 from http.server import BaseHTTPRequestHandler
-from telegram import Update
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler
+import asyncio
 import json
-import os
-from bot import bot  # Импортируем экземпляр бота из bot.py
+from webhook_server import process_update_json  # Application собирается один раз на процесс
+
+# Один event loop на весь "теплый" экземпляр функции: Application и
+# HTTP-сессия привязаны к нему и переживают отдельные запросы
+loop = asyncio.new_event_loop()
 
 class handler(BaseHTTPRequestHandler):
     async def handle_webhook(self):
@@ -12,18 +14,8 @@ class handler(BaseHTTPRequestHandler):
             post_data = self.rfile.read(content_length)
             update_data = json.loads(post_data)
             
-            # Создаем объект Update из данных
-            telegram_update = Update.de_json(update_data, None)
-            
-            # Создаем приложение
-            application = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
-            
-            # Регистрируем обработчики
-            application.add_handler(CommandHandler('start', bot.start))
-            application.add_handler(CallbackQueryHandler(bot.button_handler))
-            
             # Обрабатываем update
-            await application.process_update(telegram_update)
+            await process_update_json(update_data)
             
             self.send_response(200)
             self.end_headers()
@@ -36,5 +28,4 @@ class handler(BaseHTTPRequestHandler):
             self.wfile.write(str(e).encode())
 
     def do_POST(self):
-        import asyncio
-        asyncio.run(self.handle_webhook()) 
\ No newline at end of file
+        loop.run_until_complete(self.handle_webhook())
@@ -1,24 +1,12 @@
-from bot import AvitoBot
-from telegram import Update
-from telegram.ext import Application
+from webhook_server import process_update_json
 import json
-import os
 
 async def handle_webhook(request):
     try:
-        bot = AvitoBot()
-        app = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
-        
-        # Регистрируем обработчики
-        app.add_handler(CommandHandler('start', bot.start))
-        app.add_handler(CallbackQueryHandler(bot.button_handler))
-        # ... другие обработчики
-        
-        # Обрабатываем update
-        update = Update.de_json(json.loads(request.body), app.bot)
-        await app.process_update(update)
+        # Application и AvitoBot создаются один раз на процесс, а не на каждый запрос
+        await process_update_json(json.loads(request.body))
         
         return {'statusCode': 200}
     except Exception as e:
         print(f"Error processing update: {e}")
-        return {'statusCode': 500} 
\ No newline at end of file
+        return {'statusCode': 500}
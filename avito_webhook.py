@@ -0,0 +1,220 @@
+import asyncio
+import hmac
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from aiohttp import web
+
+from http_client import http_client, AVITO_API_BASE_URL
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес, на который Avito будет слать события мессенджера.
+# Если не задан, бот работает только опросом.
+AVITO_WEBHOOK_URL = os.getenv('AVITO_WEBHOOK_URL')
+AVITO_WEBHOOK_PATH = os.getenv('AVITO_WEBHOOK_PATH', '/avito/webhook')
+AVITO_WEBHOOK_SECRET = os.getenv('AVITO_WEBHOOK_SECRET', '')
+AVITO_WEBHOOK_HOST = os.getenv('AVITO_WEBHOOK_HOST', '0.0.0.0')
+AVITO_WEBHOOK_PORT = int(os.getenv('AVITO_WEBHOOK_PORT', '8081'))
+# При включенном webhook опрос остается как редкая сверка
+AVITO_RECONCILE_INTERVAL = int(os.getenv('AVITO_RECONCILE_INTERVAL', '600'))
+
+SUBSCRIBE_URL = f'{AVITO_API_BASE_URL}/messenger/v3/webhook'
+DEDUP_SIZE = 10000
+ACCOUNTS_REFRESH_INTERVAL = 60
+
+
+def webhook_enabled():
+    return bool(AVITO_WEBHOOK_URL)
+
+
+def webhook_url():
+    """Полный адрес подписки; секрет в пути отсекает чужие запросы"""
+    path = AVITO_WEBHOOK_PATH
+    if AVITO_WEBHOOK_SECRET:
+        path = f"{path}/{AVITO_WEBHOOK_SECRET}"
+    return AVITO_WEBHOOK_URL.rstrip('/') + path
+
+
+class AvitoWebhookReceiver:
+    """Принимает события мессенджера Avito и сразу запускает автоответ.
+
+    Повторные доставки одного события отбрасываются по id события и id
+    сообщения. Обработка идет в фоне, Avito получает 200 сразу.
+    """
+
+    def __init__(self, bot, dedup_size=DEDUP_SIZE):
+        self.bot = bot
+        self.dedup_size = dedup_size
+        self._seen = OrderedDict()
+        self._accounts = {}  # avito_user_id -> user_data
+        self._accounts_loaded_at = 0
+        self._tasks = set()
+        self._subscribed = set()  # avito_user_id с подтвержденной подпиской
+        self._subscriber = None
+        self._runner = None
+        self.received = 0
+        self.duplicates = 0
+        self.replies_queued = 0
+
+    # --- подписка ---
+
+    async def subscribe_all(self):
+        """Подписывает на webhook активные аккаунты, у которых еще нет подписки.
+
+        Возвращает число новых подписок; неудачные повторяются при следующем вызове.
+        """
+        self._refresh_accounts(force=True)
+        session = await http_client.session()
+        url = webhook_url()
+        subscribed = 0
+        for avito_user_id, user_data in list(self._accounts.items()):
+            if avito_user_id in self._subscribed:
+                continue
+            try:
+                status, _ = await self.bot.avito_request(
+                    session, 'POST', SUBSCRIBE_URL, user_data, json={'url': url}
+                )
+                if status == 200:
+                    self._subscribed.add(avito_user_id)
+                    subscribed += 1
+                else:
+                    logger.warning("Avito webhook subscribe failed for %s: %s", user_data['user_id'], status)
+            except Exception as e:
+                logger.error("Avito webhook subscribe error for %s: %s", user_data['user_id'], e)
+        return subscribed
+
+    def start_subscriptions(self, interval=ACCOUNTS_REFRESH_INTERVAL):
+        """Подписка в фоне: сразу после старта, затем каждые interval секунд для новых аккаунтов.
+
+        Аккаунт, включивший автоответ или закончивший настройку после старта,
+        получает подписку в пределах interval, а не ждет сверочного опроса.
+        """
+        if self._subscriber is None:
+            self._subscriber = asyncio.create_task(self._subscribe_loop(interval))
+
+    async def _subscribe_loop(self, interval):
+        while True:
+            try:
+                subscribed = await self.subscribe_all()
+                if subscribed:
+                    logger.info("Avito webhook subscribed for %s accounts", subscribed)
+            except Exception as e:
+                logger.error("Avito webhook subscription pass failed: %s", e)
+            await asyncio.sleep(interval)
+
+    # --- прием событий ---
+
+    def add_routes(self, app):
+        app.router.add_post(AVITO_WEBHOOK_PATH + '/{secret}', self.handle)
+        app.router.add_post(AVITO_WEBHOOK_PATH, self.handle)
+
+    async def start(self, host=AVITO_WEBHOOK_HOST, port=AVITO_WEBHOOK_PORT):
+        """Поднимает отдельный HTTP-сервер (для polling-режима main())"""
+        app = web.Application()
+        self.add_routes(app)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        return site
+
+    async def stop(self):
+        if self._subscriber is not None:
+            self._subscriber.cancel()
+            await asyncio.gather(self._subscriber, return_exceptions=True)
+            self._subscriber = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request):
+        secret = request.match_info.get('secret', '')
+        if AVITO_WEBHOOK_SECRET and not hmac.compare_digest(secret, AVITO_WEBHOOK_SECRET):
+            return web.Response(status=403)
+
+        try:
+            event = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        self.received += 1
+        task = asyncio.create_task(self.process_event(event))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({'ok': True})
+
+    def _is_duplicate(self, key):
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            return True
+        self._seen[key] = True
+        if len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
+        return False
+
+    def _refresh_accounts(self, force=False):
+        if not force and time.monotonic() - self._accounts_loaded_at < ACCOUNTS_REFRESH_INTERVAL:
+            return
+        self._accounts = {
+            str(user_data['avito_user_id']): user_data
+            for user_data in self.bot.get_active_users()
+        }
+        self._accounts_loaded_at = time.monotonic()
+
+    def _find_account(self, avito_user_id):
+        user_data = self._accounts.get(avito_user_id)
+        if user_data is None:
+            # Аккаунт мог включить автоответ после последней загрузки
+            self._refresh_accounts()
+            user_data = self._accounts.get(avito_user_id)
+        return user_data
+
+    async def process_event(self, event):
+        """Обрабатывает одно событие. Возвращает True, если автоответ поставлен в очередь"""
+        from bot import PollStats
+
+        payload = event.get('payload') or {}
+        if payload.get('type') != 'message':
+            return False
+        value = payload.get('value') or {}
+
+        chat_id = value.get('chat_id')
+        avito_user_id = str(value.get('user_id', ''))
+        if not chat_id or not avito_user_id:
+            return False
+
+        # Собственные исходящие сообщения тоже приходят событием
+        if str(value.get('author_id')) == avito_user_id:
+            return False
+
+        dedup_key = event.get('id') or value.get('id') or (chat_id, value.get('created'))
+        if self._is_duplicate(dedup_key):
+            self.duplicates += 1
+            return False
+
+        user_data = self._find_account(avito_user_id)
+        if user_data is None:
+            return False
+
+        try:
+            session = await http_client.session()
+            stats = PollStats()
+            queued = await self.bot.reply_to_chat(
+                session, user_data, chat_id, value.get('created', int(time.time())), stats
+            )
+        except Exception as e:
+            logger.error("Error replying to Avito webhook event in chat %s: %s", chat_id, e)
+            # Ответ не поставлен: повторная доставка Avito не должна отброситься как дубликат
+            self._seen.pop(dedup_key, None)
+            return False
+
+        # Аккаунт ожил: сверочный опрос возвращается к быстрому интервалу
+        self.bot.poll_scheduler.mark_active(user_data['user_id'])
+        if queued:
+            self.replies_queued += 1
+        return queued
@@ -0,0 +1,537 @@
+"""Нагрузочный бенчмарк: настоящий код бота против локальных заглушек API.
+
+Поднимает один aiohttp-сервер, который изображает api.avito.ru (token,
+chats, messages, uploadImages, balance), enter.tochka.com и Telegram Bot API
+с настраиваемой задержкой, долей ошибок и числом чатов. Firestore заменяется
+словарем в памяти, SQLite пишет во временный файл. Сценарии:
+
+    poll     — циклы check_messages + отправка ответов через reply_sender
+    balance  — check_balance_periodically по всем аккаунтам
+    payment  — создание QR, проверка статуса и зачисление платежа
+
+    python benchmarks/load.py --accounts 1000 --chats 5 --cycles 3 --latency 50
+    python benchmarks/load.py --accounts 100 --error-rate 0.05 --json result.json
+
+Лимиты самого бота берутся из окружения (AVITO_RATE_LIMIT, POLL_CONCURRENCY,
+REPLY_WORKERS и т.д.), поэтому одинаковые прогоны можно сравнивать между
+версиями кода, меняя только их.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import types
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = '123456:bench'
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def summary(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+class MockApis:
+    """Заглушки Avito, Точки и Bot API на одном порту под префиксами /avito, /tochka, /tg"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.chats = {}  # avito_user_id -> {chat_id: created}, только непрочитанные
+        self.reply_lags = []
+        self.requests = {}
+        self.balances = {}
+        self.runner = None
+        self.base_url = None
+
+    def add_chats(self, avito_user_id, count):
+        now = time.time()
+        chats = self.chats.setdefault(str(avito_user_id), {})
+        for _ in range(count):
+            chats[f'u2i-{uuid.uuid4().hex}'] = now
+
+    async def _simulate(self, request, name, fail=True):
+        self.requests[name] = self.requests.get(name, 0) + 1
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if fail and self.throttle_rate and self.random.random() < self.throttle_rate:
+            return self._web.json_response({'error': 'too many requests'}, status=429,
+                                           headers={'Retry-After': '1'})
+        if fail and self.error_rate and self.random.random() < self.error_rate:
+            return self._web.json_response({'error': 'internal'}, status=500)
+        return None
+
+    # --- Avito ---
+
+    async def avito_token(self, request):
+        error = await self._simulate(request, 'avito.token')
+        if error is not None:
+            return error
+        return self._web.json_response({'access_token': uuid.uuid4().hex, 'expires_in': 86400})
+
+    async def avito_chats(self, request):
+        error = await self._simulate(request, 'avito.chats')
+        if error is not None:
+            return error
+        chats = self.chats.get(request.match_info['account'], {})
+        limit = int(request.query.get('limit', 100))
+        offset = int(request.query.get('offset', 0))
+        ordered = sorted(chats.items(), key=lambda item: item[1], reverse=True)
+        page = [
+            {'id': chat_id, 'last_message': {'created': created, 'direction': 'in'}}
+            for chat_id, created in ordered[offset:offset + limit]
+        ]
+        return self._web.json_response({'chats': page})
+
+    async def avito_message(self, request):
+        error = await self._simulate(request, 'avito.messages')
+        if error is not None:
+            return error
+        chats = self.chats.get(request.match_info['account'], {})
+        created = chats.pop(request.match_info['chat'], None)
+        if created is not None:
+            self.reply_lags.append(time.time() - created)
+        return self._web.json_response({'id': uuid.uuid4().hex, 'created': int(time.time())})
+
+    async def avito_image_message(self, request):
+        error = await self._simulate(request, 'avito.messages_image')
+        if error is not None:
+            return error
+        return self._web.json_response({'id': uuid.uuid4().hex})
+
+    async def avito_upload(self, request):
+        error = await self._simulate(request, 'avito.upload_images')
+        if error is not None:
+            return error
+        await request.read()
+        return self._web.json_response({uuid.uuid4().hex: {'640x480': 'https://example.invalid/image.jpg'}})
+
+    async def avito_balance(self, request):
+        error = await self._simulate(request, 'avito.balance')
+        if error is not None:
+            return error
+        real = self.balances.get(request.match_info['account'], 1000)
+        return self._web.json_response({'real': real, 'bonus': 0})
+
+    async def avito_advance(self, request):
+        error = await self._simulate(request, 'avito.advance')
+        if error is not None:
+            return error
+        return self._web.json_response({'balance': 50000})
+
+    async def avito_webhook(self, request):
+        await self._simulate(request, 'avito.webhook', fail=False)
+        return self._web.json_response({'ok': True})
+
+    # --- Точка ---
+
+    async def tochka_customers(self, request):
+        error = await self._simulate(request, 'tochka.customers')
+        if error is not None:
+            return error
+        return self._web.json_response({'customers': [{'customerCode': '300000001', 'customerType': 'Business'}]})
+
+    async def tochka_customer(self, request):
+        error = await self._simulate(request, 'tochka.customer')
+        if error is not None:
+            return error
+        return self._web.json_response({'merchantId': 'MF0000000001', 'accountId': '40702810000000000001/044525104'})
+
+    async def tochka_register_qr(self, request):
+        error = await self._simulate(request, 'tochka.register_qr')
+        if error is not None:
+            return error
+        return self._web.json_response({'qrcId': f'AS{uuid.uuid4().hex[:30].upper()}', 'image': {}})
+
+    async def tochka_activate_qr(self, request):
+        error = await self._simulate(request, 'tochka.activate_qr')
+        if error is not None:
+            return error
+        return self._web.json_response({})
+
+    async def tochka_payment_status(self, request):
+        error = await self._simulate(request, 'tochka.payment_status')
+        if error is not None:
+            return error
+        return self._web.json_response({'status': 'SUCCESS'})
+
+    # --- Telegram ---
+
+    async def telegram(self, request):
+        method = request.match_info['method']
+        await self._simulate(request, f'telegram.{method}', fail=False)
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        else:
+            result = {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': 1, 'type': 'private'},
+                'text': 'ok',
+            }
+        return self._web.json_response({'ok': True, 'result': result})
+
+    async def start(self, host='127.0.0.1', port=0):
+        from aiohttp import web
+        self._web = web
+
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        avito = '/avito'
+        app.router.add_post(f'{avito}/token', self.avito_token)
+        app.router.add_get(f'{avito}/messenger/v2/accounts/{{account}}/chats', self.avito_chats)
+        app.router.add_post(f'{avito}/messenger/v1/accounts/{{account}}/chats/{{chat}}/messages',
+                            self.avito_message)
+        app.router.add_post(f'{avito}/messenger/v1/accounts/{{account}}/chats/{{chat}}/messages/image',
+                            self.avito_image_message)
+        app.router.add_post(f'{avito}/messenger/v1/accounts/{{account}}/uploadImages', self.avito_upload)
+        app.router.add_get(f'{avito}/core/v1/accounts/{{account}}/balance/', self.avito_balance)
+        app.router.add_post(f'{avito}/cpa/v3/balanceInfo', self.avito_advance)
+        app.router.add_post(f'{avito}/messenger/v3/webhook', self.avito_webhook)
+        tochka = '/tochka'
+        app.router.add_get(f'{tochka}/open/v2/customers', self.tochka_customers)
+        app.router.add_get(f'{tochka}/open/v2/customers/{{code}}', self.tochka_customer)
+        app.router.add_post(f'{tochka}/sbp/v2/cashbox_qr_code', self.tochka_register_qr)
+        app.router.add_post(f'{tochka}/sbp/v2/cashbox_qr_code/{{qrc}}/activate', self.tochka_activate_qr)
+        app.router.add_get(f'{tochka}/sbp/v2/cashbox_qr_code/{{qrc}}/payment-status', self.tochka_payment_status)
+        app.router.add_post('/tg/bot{token}/{method}', self.telegram)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f'http://{host}:{port}'
+        return self.base_url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+class MemoryFirestore:
+    """Минимум Firestore, который использует бот: документы users, where(==), batch"""
+
+    def __init__(self):
+        self.collections = {}
+
+    def collection(self, name):
+        return _MemoryCollection(self.collections.setdefault(name, {}))
+
+    def batch(self):
+        return _MemoryBatch()
+
+
+class _MemorySnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class _MemoryDocument:
+    def __init__(self, docs, doc_id):
+        self._docs = docs
+        self.id = doc_id
+
+    def get(self):
+        return _MemorySnapshot(self.id, self._docs.get(self.id))
+
+    def set(self, data, merge=False):
+        if merge and self.id in self._docs:
+            self._docs[self.id].update(data)
+        else:
+            self._docs[self.id] = dict(data)
+
+
+class _MemoryCollection:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def document(self, doc_id):
+        return _MemoryDocument(self._docs, doc_id)
+
+    def where(self, field, op, value):
+        if op != '==':
+            raise NotImplementedError(op)
+        return _MemoryQuery([(doc_id, data) for doc_id, data in self._docs.items() if data.get(field) == value])
+
+    def stream(self):
+        return [_MemorySnapshot(doc_id, data) for doc_id, data in self._docs.items()]
+
+
+class _MemoryQuery:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def stream(self):
+        return [_MemorySnapshot(doc_id, data) for doc_id, data in self._docs]
+
+
+class _MemoryBatch:
+    def __init__(self):
+        self._writes = []
+
+    def set(self, document, data, merge=False):
+        self._writes.append((document, data, merge))
+
+    def commit(self):
+        for document, data, merge in self._writes:
+            document.set(data, merge=merge)
+        self._writes = []
+
+
+def make_users(accounts, image_share, low_balance_share, apis, rnd):
+    users = {}
+    for index in range(accounts):
+        user_id = str(100000 + index)
+        avito_user_id = str(900000 + index)
+        users[user_id] = {
+            'client_id': f'client-{index}',
+            'client_secret': f'secret-{index}',
+            'avito_user_id': avito_user_id,
+            'template': 'Здравствуйте! Отвечу в ближайшее время.',
+            'auto_reply_enabled': True,
+            'auto_reply_start_time': 0,
+        }
+        if rnd.random() < image_share:
+            users[user_id]['image_file_id'] = f'file-{index}'
+        if rnd.random() < low_balance_share:
+            apis.balances[avito_user_id] = 100
+    return users
+
+
+async def wait_for_queue(bot, timeout):
+    """Ждет, пока reply_sender разберет очередь. Возвращает время ожидания"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        depth = bot.reply_queue.depth()
+        if depth['pending'] + depth['sending'] == 0:
+            break
+        await asyncio.sleep(0.05)
+    return time.perf_counter() - started
+
+
+async def run_poll(bot, apis, users, args):
+    from poll_scheduler import AdaptivePollScheduler
+
+    # Каждый цикл опрашиваем все аккаунты, а не по адаптивному расписанию
+    bot.poll_scheduler = AdaptivePollScheduler(min_interval=0, max_interval=0)
+    bot._active_users_synced_at = None
+    bot.reply_sender.start()
+
+    cycles = []
+    drains = []
+    replies_before = bot.reply_sender.sent
+    started = time.perf_counter()
+    for cycle in range(args.cycles):
+        chats = args.chats if cycle == 0 else args.new_chats
+        for user_data in users.values():
+            apis.add_chats(user_data['avito_user_id'], chats)
+        stats = await bot.check_messages(None)
+        cycles.append(stats.duration)
+        drains.append(await wait_for_queue(bot, args.drain_timeout))
+    elapsed = time.perf_counter() - started
+    await bot.reply_sender.stop()
+
+    replies = bot.reply_sender.sent - replies_before
+    return {
+        'cycles': summary(cycles),
+        'drain': summary(drains),
+        'reply_lag': summary(apis.reply_lags),
+        'replies_sent': replies,
+        'replies_failed': bot.reply_sender.failed,
+        'throughput_replies_per_s': replies / elapsed if elapsed else 0.0,
+        'elapsed': elapsed,
+    }
+
+
+async def run_balance(bot, apis, args):
+    from telegram import Bot
+
+    async with Bot(BOT_TOKEN, base_url=f'{apis.base_url}/tg/bot') as telegram_bot:
+        context = types.SimpleNamespace(bot=telegram_bot)
+        runs = []
+        for _ in range(args.balance_runs):
+            bot._balance_cache.clear()
+            started = time.perf_counter()
+            await bot.check_balance_periodically(context)
+            runs.append(time.perf_counter() - started)
+    return {
+        'runs': summary(runs),
+        'accounts_per_s': args.accounts / statistics.median(runs) if runs else 0.0,
+        'warnings_sent': apis.requests.get('telegram.sendMessage', 0),
+    }
+
+
+async def run_payment(bot, apis, users, args):
+    from bot import PaymentService
+
+    service = PaymentService(os.environ['TOCHKA_JWT_TOKEN'])
+    semaphore = asyncio.Semaphore(args.concurrency)
+    user_ids = list(users)
+    flows = []
+    completed = 0
+
+    async def flow(index):
+        nonlocal completed
+        async with semaphore:
+            started = time.perf_counter()
+            payment = await service.create_payment_qr(990, 1, user_ids[index % len(user_ids)])
+            if payment is None:
+                return
+            status = await service.check_payment_status(payment['qrc_id'])
+            if status == 'SUCCESS' and await bot.process_successful_payment(
+                    user_ids[index % len(user_ids)], payment['qrc_id']):
+                completed += 1
+            flows.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(flow(index) for index in range(args.payments)))
+    elapsed = time.perf_counter() - started
+    return {
+        'flows': summary(flows),
+        'completed': completed,
+        'throughput_payments_per_s': completed / elapsed if elapsed else 0.0,
+    }
+
+
+async def run(args):
+    apis = MockApis(args.latency / 1000, args.jitter / 1000, args.error_rate, args.throttle_rate, args.seed)
+    base_url = await apis.start()
+    os.environ['AVITO_API_BASE_URL'] = f'{base_url}/avito'
+    os.environ['TOCHKA_API_BASE_URL'] = f'{base_url}/tochka'
+    os.environ['TELEGRAM_API_BASE_URL'] = f'{base_url}/tg/bot'
+
+    # bot читает настройки при импорте, поэтому импортируем после окружения
+    import bot as bot_module
+    from http_client import http_client
+    from storage import close_databases
+
+    rnd = random.Random(args.seed)
+    bot = bot_module.get_bot()
+    firestore = MemoryFirestore()
+    users = make_users(args.accounts, args.image_share, args.low_balance_share, apis, rnd)
+    firestore.collections['users'] = users
+    bot._db = firestore
+
+    results = {'config': vars(args)}
+    try:
+        if 'poll' in args.scenarios:
+            results['poll'] = await run_poll(bot, apis, users, args)
+        if 'balance' in args.scenarios:
+            results['balance'] = await run_balance(bot, apis, args)
+        if 'payment' in args.scenarios:
+            results['payment'] = await run_payment(bot, apis, users, args)
+    finally:
+        bot.replied_chats.flush()
+        close_databases()
+        await http_client.close()
+        await apis.stop()
+    results['mock_requests'] = dict(sorted(apis.requests.items()))
+    return results
+
+
+def print_summary(name, values, unit='s', scale=1.0):
+    if not values['count']:
+        print(f"{name:22} нет данных")
+        return
+    print(f"{name:22} n={values['count']:<7} p50 {values['p50'] * scale:9.3f} {unit}   "
+          f"p99 {values['p99'] * scale:9.3f} {unit}   max {values['max'] * scale:9.3f} {unit}")
+
+
+def report(results):
+    config = results['config']
+    print(f"Аккаунтов: {config['accounts']}, задержка API: {config['latency']} мс "
+          f"(+{config['jitter']} мс), ошибки: {config['error_rate']:.0%}, 429: {config['throttle_rate']:.0%}")
+    if 'poll' in results:
+        poll = results['poll']
+        print('\npoll')
+        print_summary('цикл check_messages', poll['cycles'])
+        print_summary('разбор очереди', poll['drain'])
+        print_summary('reply lag', poll['reply_lag'])
+        print(f"{'ответов':22} отправлено {poll['replies_sent']}, неудачно {poll['replies_failed']}, "
+              f"{poll['throughput_replies_per_s']:.1f} ответов/с")
+    if 'balance' in results:
+        balance = results['balance']
+        print('\nbalance')
+        print_summary('проход по балансам', balance['runs'])
+        print(f"{'скорость':22} {balance['accounts_per_s']:.1f} аккаунтов/с, "
+              f"предупреждений: {balance['warnings_sent']}")
+    if 'payment' in results:
+        payment = results['payment']
+        print('\npayment')
+        print_summary('QR → статус → зачисление', payment['flows'], 'ms', 1000)
+        print(f"{'платежей':22} {payment['completed']}, {payment['throughput_payments_per_s']:.1f} платежей/с")
+    print('\nЗапросов к заглушкам:')
+    for name, count in results['mock_requests'].items():
+        print(f"  {name:28} {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--accounts', type=int, default=100)
+    parser.add_argument('--chats', type=int, default=5, help='непрочитанных чатов на аккаунт к первому циклу')
+    parser.add_argument('--new-chats', type=int, default=1, help='новых чатов на аккаунт к каждому следующему циклу')
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=20, help='задержка ответа заглушек, мс')
+    parser.add_argument('--jitter', type=float, default=10, help='случайная добавка к задержке, мс')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='доля ответов 429 с Retry-After')
+    parser.add_argument('--image-share', type=float, default=0.0, help='доля аккаунтов с картинкой в автоответе')
+    parser.add_argument('--low-balance-share', type=float, default=0.1)
+    parser.add_argument('--balance-runs', type=int, default=2)
+    parser.add_argument('--payments', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=20, help='параллельных платежей')
+    parser.add_argument('--drain-timeout', type=float, default=300)
+    parser.add_argument('--scenarios', default='poll,balance,payment')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='сохранить результаты в файл для сравнения прогонов')
+    parser.add_argument('--verbose', action='store_true', help='логи бота на уровне INFO (по умолчанию WARNING)')
+    args = parser.parse_args()
+    args.scenarios = set(args.scenarios.split(','))
+
+    workdir = tempfile.mkdtemp(prefix='avito-bench-')
+    os.environ['DB_PATH'] = os.path.join(workdir, 'bench.db')
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', BOT_TOKEN)
+    os.environ.setdefault('TOCHKA_JWT_TOKEN', 'bench')
+    os.environ['USER_CACHE_LISTEN'] = '0'
+    os.environ['METRICS_PORT'] = '0'
+    # Построчные логи бота на тысячах аккаунтов заметно искажают замер
+    os.environ['LOG_LEVEL'] = 'INFO' if args.verbose else 'WARNING'
+
+    results = asyncio.run(run(args))
+    report(results)
+    if args.json:
+        results['config']['scenarios'] = sorted(args.scenarios)
+        with open(args.json, 'w') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, ROOT)
+    main()
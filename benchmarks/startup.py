@@ -0,0 +1,126 @@
+"""Бенчмарк холодного старта: импорт bot + обработка первого апдейта.
+
+Каждый прогон идет в отдельном процессе, чтобы импорты были "холодными".
+Bot API подменяется локальной заглушкой, поэтому сеть не нужна.
+
+    python benchmarks/startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+START_UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': 1, 'type': 'private'},
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'bench'},
+        'text': '/start',
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+    },
+}
+
+
+async def start_telegram_stub():
+    """Минимальная заглушка Bot API: getMe и sendMessage"""
+    from aiohttp import web
+
+    async def handle(request):
+        method = request.match_info['method']
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        else:
+            result = {
+                'message_id': 2,
+                'date': int(time.time()),
+                'chat': {'id': 1, 'type': 'private'},
+                'text': 'ok',
+            }
+        return web.json_response({'ok': True, 'result': result})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}/bot'
+
+
+def child():
+    import asyncio
+
+    started = time.perf_counter()
+    import bot  # noqa: F401
+    import_bot = time.perf_counter() - started
+
+    started = time.perf_counter()
+    import webhook_server
+    import_server = time.perf_counter() - started
+
+    async def first_update():
+        runner, base_url = await start_telegram_stub()
+        os.environ['TELEGRAM_API_BASE_URL'] = base_url
+        try:
+            started = time.perf_counter()
+            application = await webhook_server.get_application()
+            init = time.perf_counter() - started
+
+            started = time.perf_counter()
+            await webhook_server.process_update_json(START_UPDATE)
+            update = time.perf_counter() - started
+            await application.shutdown()
+            return init, update
+        finally:
+            await runner.cleanup()
+
+    init, update = asyncio.run(first_update())
+    print(json.dumps({
+        'import_bot': import_bot,
+        'import_webhook_server': import_server,
+        'application_init': init,
+        'first_update': update,
+        'firebase_imported': 'firebase_admin' in sys.modules,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child()
+        return
+
+    env = dict(os.environ, TELEGRAM_BOT_TOKEN='123456:bench', USER_CACHE_LISTEN='0')
+    results = []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child'],
+            cwd=ROOT, env=env, check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        result['process_total'] = time.perf_counter() - started
+        results.append(result)
+
+    print(f"Прогонов: {args.runs}")
+    for key in ('import_bot', 'import_webhook_server', 'application_init', 'first_update', 'process_total'):
+        values = [r[key] * 1000 for r in results]
+        print(f"{key:24} median {statistics.median(values):8.1f} ms   max {max(values):8.1f} ms")
+    print(f"firebase_admin импортирован: {any(r['firebase_imported'] for r in results)}")
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, ROOT)
+    main()
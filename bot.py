@@ -6,23 +6,37 @@ from telegram.ext import (
     ContextTypes, 
     ConversationHandler, 
     MessageHandler, 
-    filters
+    filters,
+    TypeHandler
 )
+from telegram.request import HTTPXRequest
 import aiohttp
-import sqlite3
 import asyncio
 from datetime import datetime
 import base64
 import os
 import re
-import io
-# from PIL import Image
 from dotenv import load_dotenv
 import logging
 import json
 import sys
-import firebase_admin
-from firebase_admin import credentials, firestore
+import threading
+import time
+from http_client import http_client, AVITO_API_BASE_URL, TOCHKA_API_BASE_URL
+from storage import RepliedChatIndex, ImageAssetCache, DB_PATH, get_database, close_databases
+from user_cache import UserCache, is_miss
+from user_updates import UserUpdateBatch
+from avito_webhook import AvitoWebhookReceiver, webhook_enabled, AVITO_RECONCILE_INTERVAL
+from rate_limit import RateLimiter, RetryLater, AVITO_MAX_RETRIES, BACKOFF_CAP, parse_retry_after, backoff_delay, should_retry
+from reply_queue import ReplyQueue, ReplySender
+from broadcast import Broadcaster
+from poll_scheduler import AdaptivePollScheduler, POLL_MIN_INTERVAL, POLL_TICK
+from sharding import create_coordinator, create_chat_state
+from retention import RepliedChatRetention, RETENTION_INTERVAL
+from payment_reconciler import PaymentReconciler, PAYMENT_RECONCILE_INTERVAL
+from log_setup import setup_logging
+from state_store import create_state_store, OnboardingCredentials, ConversationStates, STATE_PURGE_INTERVAL
+import metrics
 
 # В начале файла
 load_dotenv()  # Загружаем переменные окружения
@@ -36,39 +50,224 @@ load_dotenv()  # Загружаем переменные окружения
     WAITING_IMAGE,  # Новое состояние
 ) = range(5)
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]  # Логируем в stdout вместо файла
-)
+# Сколько аккаунтов опрашивается одновременно за один цикл check_messages
+POLL_CONCURRENCY = int(os.getenv('POLL_CONCURRENCY', '20'))
+# Постраничное чтение чатов: размер страницы (максимум API) и предел страниц за опрос
+CHATS_PAGE_SIZE = 100
+CHATS_MAX_PAGES = int(os.getenv('CHATS_MAX_PAGES', '10'))
+# Как часто перечитывать список активных пользователей из Firestore
+ACTIVE_USERS_REFRESH = int(os.getenv('ACTIVE_USERS_REFRESH', '60'))
+# Сколько секунд данные о балансе считаются свежими
+BALANCE_CACHE_TTL = int(os.getenv('BALANCE_CACHE_TTL', '120'))
+# За сколько секунд до истечения expires_in обновлять токен Avito
+TOKEN_REFRESH_MARGIN = int(os.getenv('TOKEN_REFRESH_MARGIN', '300'))
+# Сколько секунд хранить merchantId/accountId из Точки
+MERCHANT_INFO_TTL = int(os.getenv('MERCHANT_INFO_TTL', str(6 * 60 * 60)))
+
+# Настройка логирования: stdout через очередь, уровни и формат из LOG_* переменных
+setup_logging()
+logger = logging.getLogger('bot')
+
+class PollStats:
+    """Итоги одного цикла опроса аккаунтов"""
+    def __init__(self):
+        self.accounts_polled = 0
+        self.chats_seen = 0
+        self.replies_queued = 0
+        self.errors = 0
+        self.started_at = time.monotonic()
+        self.duration = None
+
+    def finish(self):
+        self.duration = time.monotonic() - self.started_at
+
+    def as_dict(self):
+        return {
+            'accounts_polled': self.accounts_polled,
+            'chats_seen': self.chats_seen,
+            'replies_queued': self.replies_queued,
+            'errors': self.errors,
+            'duration': self.duration,
+        }
+
+    def __str__(self):
+        return (
+            f"аккаунтов: {self.accounts_polled}, чатов: {self.chats_seen}, "
+            f"ответов в очередь: {self.replies_queued}, ошибок: {self.errors}, "
+            f"время: {self.duration or 0:.1f} с"
+        )
+
+class TokenCache:
+    """Кэш OAuth-токенов Avito по client_id.
+
+    Токен обновляется за refresh_margin секунд до истечения expires_in,
+    а параллельные запросы одного аккаунта ждут одно общее обновление.
+    """
+    def __init__(self, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._tokens = {}  # client_id -> (access_token, expires_at)
+        self._inflight = {}  # client_id -> asyncio.Task
+        self.refreshes = 0
+
+    async def get(self, client_id, fetch):
+        entry = self._tokens.get(client_id)
+        if entry and entry[1] - self.refresh_margin > time.monotonic():
+            return entry[0]
+
+        task = self._inflight.get(client_id)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh(client_id, fetch))
+            self._inflight[client_id] = task
+            task.add_done_callback(lambda t: self._forget(client_id, t))
+        # shield: отмена одного ожидающего не отменяет общее обновление
+        return await asyncio.shield(task)
+
+    async def _refresh(self, client_id, fetch):
+        self.refreshes += 1
+        try:
+            access_token, expires_in = await fetch()
+        except Exception:
+            metrics.token_refreshes.inc(result='error')
+            raise
+        metrics.token_refreshes.inc(result='ok' if access_token else 'failed')
+        if access_token:
+            self._tokens[client_id] = (access_token, time.monotonic() + expires_in)
+        return access_token
+
+    def _forget(self, client_id, task):
+        if self._inflight.get(client_id) is task:
+            del self._inflight[client_id]
+
+    def invalidate(self, client_id, token=None):
+        """Сбрасывает токен; если передан token, то только если он все еще текущий"""
+        entry = self._tokens.get(client_id)
+        if entry and (token is None or entry[0] == token):
+            del self._tokens[client_id]
+
+class AvitoTokenError(Exception):
+    """OAuth-токен Avito не получен: /token ответил ошибкой"""
+
+def init_firestore():
+    """Инициализирует Firebase и возвращает клиент Firestore.
+
+    firebase_admin импортируется здесь, а не на уровне модуля: это самый
+    тяжелый импорт, а /start и кнопки без данных пользователя его не требуют.
+    """
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    # Инициализация Firebase
+    if not firebase_admin._apps:
+        if os.getenv('FIREBASE_CREDENTIALS'):
+            # Декодируем credentials из переменной окружения
+            cred_json = base64.b64decode(os.getenv('FIREBASE_CREDENTIALS')).decode('utf-8')
+            cred_dict = json.loads(cred_json)
+            cred = credentials.Certificate(cred_dict)
+        else:
+            # Используем локальный файл
+            cred = credentials.Certificate('firebase-credentials.json')
+        firebase_admin.initialize_app(cred)
+    return firestore.client()
 
 class AvitoBot:
     def __init__(self):
-        # Инициализация Firebase
-        if not firebase_admin._apps:
-            if os.getenv('FIREBASE_CREDENTIALS'):
-                # Декодируем credentials из переменной окружения
-                cred_json = base64.b64decode(os.getenv('FIREBASE_CREDENTIALS')).decode('utf-8')
-                cred_dict = json.loads(cred_json)
-                cred = credentials.Certificate(cred_dict)
-            else:
-                # Используем локальный файл
-                cred = credentials.Certificate('firebase-credentials.json')
-            firebase_admin.initialize_app(cred)
-        self.db = firestore.client()
-        self.temp_credentials = {}
+        # Клиент Firestore создается при первом обращении к self.db
+        self._db = None
+        self._db_lock = threading.Lock()
+        self.db_path = DB_PATH
+        self.sql = get_database(self.db_path)
+        # Шаги диалогов и недовведенные ключи переживают перезапуск и видны всем экземплярам
+        self.state = create_state_store(self)
+        self.temp_credentials = OnboardingCredentials(self.state)
+        self.conversations = ConversationStates(self.state)
+        self.poll_concurrency = POLL_CONCURRENCY
+        self.token_cache = TokenCache()
+        self.rate_limiter = RateLimiter()
+        self.replied_chats = RepliedChatIndex(self.sql)
+        self.payment_reconciler = PaymentReconciler(self, self.sql, get_payment_service)
+        self.image_assets = ImageAssetCache(self.sql)
+        self.reply_queue = ReplyQueue(self.sql)
+        self.reply_sender = ReplySender(self, self.reply_queue)
+        self._image_upload_locks = {}
+        self._balance_cache = {}
+        self._balance_inflight = {}
+        self.user_cache = UserCache()
+        self._users_watch = None
+        # С webhook Avito опрос нужен только как сверка пропущенных событий
+        self.poll_scheduler = AdaptivePollScheduler(
+            min_interval=AVITO_RECONCILE_INTERVAL if webhook_enabled() else POLL_MIN_INTERVAL
+        )
+        self._active_users_synced_at = None
+        # При SHARD_BACKEND аккаунты делятся между несколькими воркерами
+        self.shard = create_coordinator(self)
+        # Отметки чатов и закрепленные ответы видны новому владельцу аккаунта
+        self.chat_state = create_chat_state(self)
+        self.retention = RepliedChatRetention(self.sql, self.replied_chats, self.chat_state)
+
+    async def refresh_shard(self, context: ContextTypes.DEFAULT_TYPE = None):
+        """Heartbeat воркера и пересчет кольца.
+
+        Отдельная задача, а не начало check_messages: проход опроса может идти
+        дольше WORKER_TTL, и тогда остальные воркеры сочли бы этот мертвым.
+        """
+        if self.shard.refresh(force=True):
+            # Состав воркеров изменился: на следующем тике пересобираем свою долю аккаунтов
+            self._active_users_synced_at = None
+        try:
+            await self.recover_replies()
+        except Exception as e:
+            logger.error("Error recovering claimed replies: %s", e)
+
+    def owned_users(self, users):
+        """Аккаунты, которые обслуживает этот воркер"""
+        return users if self.shard is None else self.shard.filter(users)
+
+    @property
+    def db(self):
+        if self._db is None:
+            with self._db_lock:
+                if self._db is None:
+                    self._db = init_firestore()
+        return self._db
 
     def get_user(self, user_id: str):
+        cached = self.user_cache.get(user_id)
+        if not is_miss(cached):
+            return cached
+
         doc_ref = self.db.collection('users').document(user_id)
         doc = doc_ref.get()
-        if doc.exists:
-            return doc.to_dict()
-        return None
+        data = doc.to_dict() if doc.exists else None
+        self.user_cache.put(user_id, data)
+        return dict(data) if data is not None else None
 
     def save_user(self, user_id: str, data: dict):
         doc_ref = self.db.collection('users').document(user_id)
         doc_ref.set(data, merge=True)
+        self.user_cache.merge(user_id, data)
+
+    def watch_users(self):
+        """Подписывается на изменения users, чтобы кэш видел правки из других процессов"""
+        if self._users_watch is None:
+            self._users_watch = self.db.collection('users').on_snapshot(self.user_cache.on_snapshot)
+
+    def unwatch_users(self):
+        if self._users_watch is not None:
+            self._users_watch.unsubscribe()
+            self._users_watch = None
+
+    def get_active_users(self):
+        """Возвращает пользователей с включенным автоответом и заполненными ключами"""
+        users = []
+        query = self.db.collection('users').where('auto_reply_enabled', '==', True)
+        for doc in query.stream():
+            user_data = doc.to_dict()
+            if not (user_data.get('client_id') and user_data.get('client_secret')
+                    and user_data.get('avito_user_id')):
+                continue
+            user_data['user_id'] = doc.id
+            users.append(user_data)
+        return users
 
     async def manage_accounts_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.callback_query:
@@ -146,14 +345,14 @@ class AvitoBot:
             return WAITING_CLIENT_ID
             
         elif query.data == 'add_client_secret':
-            if user_id not in self.temp_credentials or 'client_id' not in self.temp_credentials[user_id]:
+            if 'client_id' not in self.temp_credentials.get(user_id):
                 await query.message.reply_text("Сначала добавьте Client ID!")
                 return ConversationHandler.END
             await query.message.reply_text("Пожалуйста, введите ваш Client Secret:")
             return WAITING_CLIENT_SECRET
             
         elif query.data == 'add_user_id':
-            if user_id not in self.temp_credentials or 'client_secret' not in self.temp_credentials[user_id]:
+            if 'client_secret' not in self.temp_credentials.get(user_id):
                 await query.message.reply_text("Сначала добавьте Client ID и Client Secret!")
                 return ConversationHandler.END
             await query.message.reply_text("Пожалуйста, введите ваш User ID:")
@@ -244,6 +443,9 @@ class AvitoBot:
                 if advance_balance is not None:
                     message += f"\nБаланс аванса: {advance_balance:.2f} ₽"
                 
+                age = int(time.time() - balances['fetched_at'])
+                message += "\n\n🕒 Данные получены только что" if age < 5 else f"\n\n🕒 Данные получены {age} с назад"
+                
                 await query.message.reply_text(message)
             else:
                 await query.message.reply_text("❌ Не удалось получить информацию о балансах")
@@ -258,20 +460,13 @@ class AvitoBot:
                 accounts_count = int(query.data.split('_')[1])
                 amount = accounts_count * 200  # 200 рублей за аккаунт
                 
-                payment_service = PaymentService(os.getenv('TOCHKA_JWT_TOKEN'))
-                qr_data = await payment_service.create_payment_qr(amount, accounts_count, user_id)
+                qr_data = await get_payment_service().create_payment_qr(amount, accounts_count, user_id)
                 
                 if qr_data:
-                    # Создаем QR-код как изображение
-                    qr = Image.open(io.BytesIO(base64.b64decode(qr_data['image'])))
-                    bio = io.BytesIO()
-                    qr.save(bio, 'PNG')
-                    bio.seek(0)
-                    
-                    # Отправляем QR-код и инструкции
+                    # PNG от Точки отправляем как есть, без перекодирования
                     await context.bot.send_photo(
                         chat_id=user_id,
-                        photo=bio,
+                        photo=qr_data['image'],
                         caption=(
                             f"💳 Оплата {accounts_count} дополнительных аккаунтов\n\n"
                             f"Сумма к оплате: {qr_data['amount']}₽\n\n"
@@ -289,15 +484,20 @@ class AvitoBot:
             except ValueError:
                 await query.answer("❌ Неверный формат данных")
             except Exception as e:
-                print(f"Error processing payment: {e}")
+                logger.error("Error processing payment: %s", e)
                 await query.answer("❌ Произошла ошибка. Попробуйте позже.")
         elif query.data.startswith('check_payment_'):
             qrc_id = query.data.split('_')[2]
-            payment_service = PaymentService(os.getenv('TOCHKA_JWT_TOKEN'))
-            status = await payment_service.check_payment_status(qrc_id)
+            # Фоновая сверка могла уже зачислить платеж: тогда в Точку не ходим.
+            # Ищем по паре с user_id, чтобы чужой qrc_id не показал успех
+            local_status = self.sql.get_qr_payment_status(qrc_id, user_id)
+            if local_status == 'succeeded':
+                status = 'SUCCESS'
+            else:
+                status = await get_payment_service().check_payment_status(qrc_id)
             
             if status == 'SUCCESS':
-                if await self.process_successful_payment(user_id, qrc_id):
+                if local_status == 'succeeded' or await self.process_successful_payment(user_id, qrc_id):
                     await query.message.edit_caption(
                         caption="✅ Оплата прошла успешно!\n\nДополнительные аккаунты активированы.",
                         reply_markup=InlineKeyboardMarkup([[
@@ -313,10 +513,7 @@ class AvitoBot:
         user_id = str(update.message.from_user.id)
         client_id = update.message.text.strip()
         
-        if user_id not in self.temp_credentials:
-            self.temp_credentials[user_id] = {}
-        
-        self.temp_credentials[user_id]['client_id'] = client_id
+        self.temp_credentials.update(user_id, client_id=client_id)
         await update.message.reply_text("✅ Client ID сохранен! Теперь добавьте Client Secret.")
         return ConversationHandler.END
 
@@ -324,7 +521,7 @@ class AvitoBot:
         user_id = str(update.message.from_user.id)
         client_secret = update.message.text.strip()
         
-        self.temp_credentials[user_id]['client_secret'] = client_secret
+        self.temp_credentials.update(user_id, client_secret=client_secret)
         
         keyboard = [
             [InlineKeyboardButton("➕ Добавить Client ID", callback_data='add_client_id')],
@@ -347,12 +544,16 @@ class AvitoBot:
         user_id = str(update.message.from_user.id)
         avito_user_id = update.message.text.strip()
         
-        self.temp_credentials[user_id]['avito_user_id'] = avito_user_id
+        credentials = self.temp_credentials.get(user_id)
+        if 'client_id' not in credentials or 'client_secret' not in credentials:
+            # Настройка брошена и истекла (ONBOARDING_TTL) или начата заново
+            await update.message.reply_text("Сначала добавьте Client ID и Client Secret!")
+            return ConversationHandler.END
         
         # Сохраняем все данные в БД
         self.save_user(user_id, {
-            'client_id': self.temp_credentials[user_id]['client_id'],
-            'client_secret': self.temp_credentials[user_id]['client_secret'],
+            'client_id': credentials['client_id'],
+            'client_secret': credentials['client_secret'],
             'avito_user_id': avito_user_id,
             'template': '',
             'auto_reply_enabled': False,
@@ -361,7 +562,7 @@ class AvitoBot:
         })
         
         # Очищаем временные данные
-        del self.temp_credentials[user_id]
+        self.temp_credentials.discard(user_id)
         
         keyboard = [
             [InlineKeyboardButton("➕ Добавить Client ID", callback_data='add_client_id')],
@@ -406,164 +607,500 @@ class AvitoBot:
         )
         return ConversationHandler.END
 
+    def track_conversation(self, callback):
+        """Оборачивает точку входа диалога: возвращенный шаг сохраняется в self.conversations"""
+        async def tracked(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            state = await callback(update, context)
+            self.conversations.set(update, state)
+            return state
+        return tracked
+
+    async def continue_conversation(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обрабатывает сообщение по шагу диалога из общего хранилища.
+
+        Шаг мог начаться в другом экземпляре бота или до перезапуска, поэтому
+        источником истины служит self.conversations, а не память ConversationHandler.
+        """
+        state = self.conversations.get(update)
+        handler = {
+            WAITING_CLIENT_ID: self.handle_client_id,
+            WAITING_CLIENT_SECRET: self.handle_client_secret,
+            WAITING_USER_ID: self.handle_user_id,
+            WAITING_TEMPLATE: self.handle_template,
+            WAITING_IMAGE: self.handle_image,
+        }.get(state)
+        if handler is None:
+            return ConversationHandler.END
+        if (state == WAITING_IMAGE) != bool(update.message.photo):
+            # Текст вместо картинки или наоборот: продолжаем ждать
+            return state
+
+        new_state = await handler(update, context)
+        self.conversations.set(update, new_state)
+        return new_state
+
+    async def flush_state(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Сбрасывает изменения состояния за апдейт одной пачкой"""
+        try:
+            self.state.flush()
+        except Exception as e:
+            logger.error("State flush failed: %s", e)
+
+    async def purge_state(self, context: ContextTypes.DEFAULT_TYPE):
+        purged = self.state.purge()
+        if purged:
+            logger.info("Expired %s abandoned conversation records", purged)
+
     async def get_token(self, client_id: str, client_secret: str) -> str:
-        async with aiohttp.ClientSession() as session:
-            data = {
-                'grant_type': 'client_credentials',
-                'client_id': client_id,
-                'client_secret': client_secret
-            }
-            async with session.post('https://api.avito.ru/token', data=data) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    return result.get('access_token')
-                return None
+        return await self.token_cache.get(
+            client_id, lambda: self._fetch_token(client_id, client_secret)
+        )
+
+    async def _fetch_token(self, client_id: str, client_secret: str):
+        session = await http_client.session()
+        data = {
+            'grant_type': 'client_credentials',
+            'client_id': client_id,
+            'client_secret': client_secret
+        }
+        await self.rate_limiter.acquire()
+        async with session.post(f'{AVITO_API_BASE_URL}/token', data=data) as response:
+            if response.status == 200:
+                result = await response.json()
+                return result.get('access_token'), result.get('expires_in', 3600)
+            return None, 0
+
+    async def avito_request(self, session, method, url, user_data, headers=None, **kwargs):
+        """Запрос к API Avito с токеном аккаунта.
+
+        Запросы проходят через rate_limiter (общий лимит и лимит аккаунта).
+        На 401 токен сбрасывается и запрос повторяется один раз, на 429/5xx и
+        сетевые ошибки — до AVITO_MAX_RETRIES раз с учетом Retry-After или
+        экспоненциальной задержкой с jitter. Retry-After длиннее BACKOFF_CAP
+        на месте не ждем: бросаем RetryLater, чтобы не держать задание очереди
+        дольше аренды и слот опроса. Если data передан как функция, тело
+        собирается заново для каждой попытки (FormData нельзя отправить
+        дважды). Возвращает (status, json).
+        """
+        account = user_data['client_id']
+        auth_retried = False
+        attempt = 0
+        while True:
+            token = await self.get_token(user_data['client_id'], user_data['client_secret'])
+            if not token:
+                return None, None
+
+            request_kwargs = dict(kwargs)
+            if callable(request_kwargs.get('data')):
+                request_kwargs['data'] = request_kwargs['data']()
+            request_headers = {**(headers or {}), 'Authorization': f'Bearer {token}'}
+
+            await self.rate_limiter.acquire(account, max_wait=BACKOFF_CAP)
+            try:
+                async with session.request(method, url, headers=request_headers, **request_kwargs) as response:
+                    if response.status == 401 and not auth_retried:
+                        self.token_cache.invalidate(user_data['client_id'], token)
+                        auth_retried = True
+                        continue
+
+                    if should_retry(response.status) and attempt < AVITO_MAX_RETRIES:
+                        delay = parse_retry_after(response.headers.get('Retry-After'))
+                        if delay is None:
+                            delay = backoff_delay(attempt)
+                        else:
+                            if response.status == 429:
+                                # Сервер сам сказал, когда приходить: притормаживаем весь аккаунт
+                                self.rate_limiter.pause(account, delay)
+                            if delay > BACKOFF_CAP:
+                                raise RetryLater(response.status, delay)
+                    else:
+                        data = None
+                        if response.status == 200:
+                            data = await response.json(content_type=None)
+                        return response.status, data
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= AVITO_MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt)
+
+            attempt += 1
+            await asyncio.sleep(delay)
 
     def save_replied_chat(self, user_id: str, chat_id: str):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('''
-            INSERT OR REPLACE INTO replied_chats (user_id, chat_id, replied_at)
-            VALUES (?, ?, ?)
-        ''', (user_id, chat_id, int(datetime.now().timestamp())))
-        conn.commit()
-        conn.close()
+        self.replied_chats.add(user_id, chat_id)
 
     def has_replied_to_chat(self, user_id: str, chat_id: str) -> bool:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        c.execute('SELECT 1 FROM replied_chats WHERE user_id = ? AND chat_id = ?', (user_id, chat_id))
-        result = c.fetchone() is not None
-        conn.close()
-        return result
+        return self.replied_chats.contains(user_id, chat_id)
 
     async def check_messages(self, context: ContextTypes.DEFAULT_TYPE):
-        users = self.get_active_users()
-        for user_data in users:
-            token = await self.get_token(user_data['client_id'], user_data['client_secret'])
-            if not token:
-                print(f"Failed to get token for user {user_data['user_id']}")
-                continue
+        """Опрашивает аккаунты, которым подошел срок по poll_scheduler.
 
-            async with aiohttp.ClientSession() as session:
-                headers = {'Authorization': f'Bearer {token}'}
-                params = {'unread_only': 'true', 'limit': '100'}
-                url = f"https://api.avito.ru/messenger/v2/accounts/{user_data['avito_user_id']}/chats"
-                
+        Опрос идет параллельно, не более poll_concurrency аккаунтов одновременно.
+        При шардировании опрашиваются только аккаунты этого воркера.
+        """
+        stats = PollStats()
+        now = time.monotonic()
+        if (self._active_users_synced_at is None
+                or now - self._active_users_synced_at >= ACTIVE_USERS_REFRESH):
+            self.poll_scheduler.sync(self.owned_users(self.get_active_users()))
+            self._active_users_synced_at = now
+        users = self.poll_scheduler.due()
+        semaphore = asyncio.Semaphore(self.poll_concurrency)
+
+        async def poll(user_data):
+            async with semaphore:
+                if self.shard is not None and not self.shard.owns(user_data['user_id']):
+                    # Кольцо поменялось, пока аккаунт ждал слота: его уже опрашивает другой воркер
+                    return
+                last_message_time = 0
                 try:
-                    async with session.get(url, headers=headers, params=params) as response:
-                        if response.status != 200:
-                            print(f"Failed to get chats: {response.status}")
-                            continue
-                        
-                        chats = await response.json()
-                        for chat in chats.get('chats', []):
-                            chat_id = chat.get('id')
-                            if not chat_id:
-                                continue
-
-                            if self.has_replied_to_chat(user_data['user_id'], chat_id):
-                                print(f"Already replied to chat {chat_id}")
-                                continue
-
-                            last_message_time = chat.get('last_message', {}).get('created', 0)
-                            if last_message_time < user_data.get('auto_reply_start_time', 0):
-                                print(f"Message in chat {chat_id} is too old")
-                                continue
-
-                            if not user_data.get('template'):
-                                print(f"No template set for user {user_data['user_id']}")
-                                continue
-
-                            # Отправляем изображение, если оно есть
-                            if user_data.get('image_file_id'):
-                                try:
-                                    upload_url = f"https://api.avito.ru/messenger/v1/accounts/{user_data['avito_user_id']}/uploadImages"
-                                    form_data = aiohttp.FormData()
-                                    form_data.add_field('uploadfile[]', 
-                                                      user_data['image_file_id'],
-                                                      filename='image.jpg',
-                                                      content_type='image/jpeg')
-                                    
-                                    async with session.post(upload_url, headers=headers, data=form_data) as upload_response:
-                                        if upload_response.status == 200:
-                                            upload_data = await upload_response.json()
-                                            image_id = list(upload_data.keys())[0]
-                                            
-                                            # Отправляем изображение
-                                            image_data = {
-                                                'image_id': image_id
-                                            }
-                                            image_url = f"https://api.avito.ru/messenger/v1/accounts/{user_data['avito_user_id']}/chats/{chat_id}/messages/image"
-                                            await session.post(image_url, headers=headers, json=image_data)
-                                            print(f"Successfully sent image to chat {chat_id}")
-                                            await asyncio.sleep(2)
-                                except Exception as e:
-                                    print(f"Error sending image: {e}")
-
-                            # Отправляем текст
-                            message_data = {
-                                'message': {'text': user_data['template']},
-                                'type': 'text'
-                            }
-                            
-                            msg_url = f"https://api.avito.ru/messenger/v1/accounts/{user_data['avito_user_id']}/chats/{chat_id}/messages"
-                            async with session.post(msg_url, headers=headers, json=message_data) as msg_response:
-                                if msg_response.status == 200:
-                                    print(f"Successfully sent message to chat {chat_id}")
-                                    self.save_replied_chat(user_data['user_id'], chat_id)
-                                else:
-                                    print(f"Failed to send message: {msg_response.status}")
+                    last_message_time = await self.poll_account(user_data, stats)
                 except Exception as e:
-                    print(f"Error checking messages for user {user_data['user_id']}: {e}")
+                    # Ошибка одного аккаунта не должна ломать весь цикл
+                    stats.errors += 1
+                    logger.error("Error checking messages for user %s: %s", user_data['user_id'], e)
+                finally:
+                    self.poll_scheduler.record(user_data['user_id'], last_message_time or 0)
+
+        await asyncio.gather(*(poll(user_data) for user_data in users))
+        # Сбрасываем буфер ответов в SQLite раз в цикл
+        self.replied_chats.flush()
+        stats.finish()
+        if users:
+            metrics.poll_cycle_seconds.observe(stats.duration)
+        return stats
+
+    async def poll_account(self, user_data, stats):
+        """Опрашивает один аккаунт. Возвращает время самого свежего нового сообщения.
+
+        Чаты приходят от свежих к старым, поэтому листаем страницы, пока не
+        дойдем до чата не новее сохраненной отметки (watermark) аккаунта.
+        За один опрос читается не больше CHATS_MAX_PAGES страниц; недочитанный
+        проход продолжается в следующий опрос, а отметка сдвигается, только
+        когда проход дошел до конца. Продолжение привязано ко времени: все чаты
+        новее resume_before в этом проходе уже обработаны. offset лишь
+        подсказка — если последний прочитанный чат сместился (чаты перед ним
+        прочитаны или отвечены и ушли из unread_only), проход перечитывается
+        с начала, иначе сдвинутые вверх чаты остались бы без ответа.
+        """
+        token = await self.get_token(user_data['client_id'], user_data['client_secret'])
+        if not token:
+            stats.errors += 1
+            logger.warning("Failed to get token for user %s", user_data['user_id'])
+            return
+
+        stats.accounts_polled += 1
+        session = await http_client.session()
+        url = f"{AVITO_API_BASE_URL}/messenger/v2/accounts/{user_data['avito_user_id']}/chats"
+        user_id = user_data['user_id']
+        watermark, resume_offset, pass_latest, resume_before, resume_chat = await self.chat_state.get_cursor(user_id)
+        start_chat = resume_chat
+        latest_message_time = 0
+        offset = resume_offset if start_chat else 0
+
+        for _ in range(CHATS_MAX_PAGES):
+            # Страница начинается с последнего прочитанного чата: по нему видно, не сдвинулся ли список
+            page_offset = offset - 1 if offset else 0
+            params = {
+                'unread_only': 'true',
+                'limit': str(CHATS_PAGE_SIZE),
+                'offset': str(page_offset),
+            }
+            status, chats = await self.avito_request(session, 'GET', url, user_data, params=params)
+            if status != 200:
+                stats.errors += 1
+                logger.warning("Failed to get chats for user %s: %s", user_id, status)
+                # Отметку не двигаем; прочитанное запоминаем, чтобы продолжить с этого места
+                if resume_chat != start_chat:
+                    await self.chat_state.save_cursor(user_id, watermark, offset, pass_latest, resume_before, resume_chat)
+                return latest_message_time
+
+            page_chats = chats.get('chats', [])
+            if page_offset:
+                first = page_chats[0] if page_chats else {}
+                first_time = first.get('last_message', {}).get('created', 0)
+                if first_time < resume_before or (first_time == resume_before and first.get('id') != resume_chat):
+                    # Чаты выше ушли из списка и он сдвинулся вверх: по offset пропустили бы
+                    # непрочитанные, читаем с начала. Сдвиг вниз новыми чатами безопасен
+                    offset = 0
                     continue
 
+            reached_watermark = False
+            for chat in page_chats:
+                last_message_time = chat.get('last_message', {}).get('created', 0)
+                if last_message_time <= watermark:
+                    reached_watermark = True
+                    break
+                chat_id = chat.get('id')
+                if not chat_id:
+                    continue
+                if chat_id == resume_chat or (resume_before and last_message_time > resume_before):
+                    # Обработан раньше в этом проходе или написан после его начала:
+                    # такой новее pass_latest, его возьмет следующий проход
+                    continue
+                stats.chats_seen += 1
+                latest_message_time = max(latest_message_time, last_message_time)
+                await self.reply_to_chat(session, user_data, chat_id, last_message_time, stats)
+            pass_latest = max(pass_latest, latest_message_time)
+            offset = page_offset + len(page_chats)
+
+            if reached_watermark or len(page_chats) < CHATS_PAGE_SIZE:
+                # Проход дочитан: отметка — самое свежее сообщение за весь проход
+                if pass_latest > watermark or start_chat:
+                    await self.chat_state.save_cursor(user_id, max(watermark, pass_latest))
+                return latest_message_time
+
+            last_chat = page_chats[-1]
+            resume_chat = last_chat.get('id')
+            last_chat_time = last_chat.get('last_message', {}).get('created', 0)
+            resume_before = min(resume_before, last_chat_time) if resume_before else last_chat_time
+
+        # Уперлись в CHATS_MAX_PAGES: следующий опрос продолжит с последнего прочитанного чата.
+        # Чаты, сдвинутые новыми сообщениями, перечитаются; повторы отсекает has_replied_to_chat
+        await self.chat_state.save_cursor(user_id, watermark, offset, pass_latest, resume_before, resume_chat)
+        # Хвост ждет: держим аккаунт на быстром интервале опроса
+        self.poll_scheduler.mark_active(user_id)
+        return latest_message_time
+
+    async def get_image_id(self, session, user_data):
+        """image_id картинки автоответа: загружается в Avito один раз на аккаунт и содержимое"""
+        avito_user_id = str(user_data['avito_user_id'])
+        content_hash = ImageAssetCache.content_hash(user_data['image_file_id'])
+        image_id = self.image_assets.get(avito_user_id, content_hash)
+        if image_id:
+            return image_id
+
+        # Параллельные чаты одного аккаунта ждут одну загрузку
+        key = (avito_user_id, content_hash)
+        lock = self._image_upload_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            image_id = self.image_assets.get(avito_user_id, content_hash)
+            if image_id:
+                return image_id
+
+            upload_url = f"{AVITO_API_BASE_URL}/messenger/v1/accounts/{avito_user_id}/uploadImages"
+
+            def build_form():
+                form_data = aiohttp.FormData()
+                form_data.add_field('uploadfile[]', 
+                                  user_data['image_file_id'],
+                                  filename='image.jpg',
+                                  content_type='image/jpeg')
+                return form_data
+
+            status, upload_data = await self.avito_request(
+                session, 'POST', upload_url, user_data, data=build_form
+            )
+            if status != 200 or not upload_data:
+                logger.warning("Failed to upload image: %s", status)
+                return None
+
+            image_id = list(upload_data.keys())[0]
+            self.image_assets.put(avito_user_id, content_hash, image_id)
+            return image_id
+
+    async def reply_to_chat(self, session, user_data, chat_id, last_message_time, stats):
+        """Ставит автоответ в очередь отправки. Общая часть опроса и webhook.
+
+        Сама отправка идет в reply_sender; повторная постановка того же чата
+        ничего не делает. Возвращает True, если задание добавлено.
+        """
+        if self.has_replied_to_chat(user_data['user_id'], chat_id):
+            logger.debug("Already replied to chat %s", chat_id)
+            return False
+
+        if last_message_time < user_data.get('auto_reply_start_time', 0):
+            logger.debug("Message in chat %s is too old", chat_id)
+            return False
+
+        if not user_data.get('template'):
+            logger.info("No template set for user %s", user_data['user_id'])
+            return False
+
+        payload = {
+            'text': user_data['template'],
+            'with_image': bool(user_data.get('image_file_id')),
+            'last_message_created': last_message_time,
+        }
+        if not await self.chat_state.claim_reply(user_data['user_id'], chat_id, payload):
+            # Ответ уже закреплен за другим воркером (аккаунт переходил между машинами)
+            logger.debug("Reply to chat %s is claimed by another worker", chat_id)
+            return False
+
+        queued = self.reply_queue.enqueue(user_data['user_id'], chat_id, payload)
+        if queued:
+            stats.replies_queued += 1
+            self.reply_sender.notify()
+        else:
+            # Чат недавно провалился в локальной очереди: закрепление не держим
+            await self.chat_state.release_reply(user_data['user_id'], chat_id)
+        return queued
+
+    async def release_queued_reply(self, job):
+        """Проваленный или отмененный ответ: другой воркер сможет поставить его заново"""
+        await self.chat_state.release_reply(job['user_id'], job['chat_id'])
+
+    async def recover_replies(self):
+        """Ставит в свою очередь ответы, закрепленные за пропавшими воркерами.
+
+        Закрепление истекает, только если ответ так и не отправлен; владелец
+        аккаунта сейчас этот воркер, поэтому ответ дойдет отсюда.
+        """
+        claims = await asyncio.to_thread(self.chat_state.reclaim_replies, self.shard.owns)
+        recovered = 0
+        for claim in claims:
+            if self.reply_queue.enqueue(claim['user_id'], claim['chat_id'], claim['payload']):
+                recovered += 1
+        if recovered:
+            logger.info("Recovered %s replies claimed by lost workers", recovered)
+            self.reply_sender.notify()
+
+    async def send_queued_reply(self, job):
+        """Отправляет одно задание из reply_queue.
+
+        Возвращает HTTP-статус текста или None, если ответ отменен (пользователя
+        нет или автоответ выключен). Если токен не получен, бросает
+        AvitoTokenError: это временная ошибка, задание повторится.
+        """
+        user_data = self.get_user(job['user_id'])
+        if not user_data or not user_data.get('auto_reply_enabled'):
+            return None
+        user_data['user_id'] = job['user_id']
+        chat_id = job['chat_id']
+        payload = job['payload']
+        session = await http_client.session()
+
+        # Отправляем изображение, если оно есть (только в первой попытке, чтобы не дублировать)
+        if payload.get('with_image') and user_data.get('image_file_id') and job['attempts'] == 1:
+            await self._send_image(session, user_data, chat_id)
+
+        # Отправляем текст
+        message_data = {
+            'message': {'text': payload['text']},
+            'type': 'text'
+        }
+        
+        msg_url = f"{AVITO_API_BASE_URL}/messenger/v1/accounts/{user_data['avito_user_id']}/chats/{chat_id}/messages"
+        status, _ = await self.avito_request(session, 'POST', msg_url, user_data, json=message_data)
+        if status is None:
+            raise AvitoTokenError(f"No Avito token for user {job['user_id']}")
+        if status == 200:
+            logger.info("Successfully sent message to chat %s", chat_id)
+            self.save_replied_chat(job['user_id'], chat_id)
+            try:
+                await self.chat_state.confirm_reply(job['user_id'], chat_id)
+            except Exception as e:
+                # Ответ уже ушел: ошибка не должна превратиться в повтор задания
+                logger.error("Failed to confirm reply to chat %s: %s", chat_id, e)
+            metrics.replies_sent.inc()
+            if payload.get('last_message_created'):
+                metrics.reply_lag_seconds.observe(max(0.0, time.time() - payload['last_message_created']))
+        else:
+            logger.warning("Failed to send message: %s", status)
+            metrics.reply_failures.inc(status=status)
+        return status
+
+    async def _send_image(self, session, user_data, chat_id):
+        try:
+            image_url = f"{AVITO_API_BASE_URL}/messenger/v1/accounts/{user_data['avito_user_id']}/chats/{chat_id}/messages/image"
+            for attempt in range(2):
+                image_id = await self.get_image_id(session, user_data)
+                if not image_id:
+                    break
+                status, _ = await self.avito_request(
+                    session, 'POST', image_url, user_data, json={'image_id': image_id}
+                )
+                if status == 200:
+                    logger.info("Successfully sent image to chat %s", chat_id)
+                    break
+                if status not in (400, 404):
+                    logger.warning("Failed to send image: %s", status)
+                    break
+                # Avito не принял image_id: забываем его и загружаем картинку заново
+                self.image_assets.invalidate(
+                    user_data['avito_user_id'],
+                    ImageAssetCache.content_hash(user_data['image_file_id'])
+                )
+        except Exception as e:
+            logger.error("Error sending image: %s", e)
+
     async def handle_image(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Временно отключаем обработку изображений
         await update.message.reply_text("Функция загрузки изображений временно недоступна")
         return ConversationHandler.END
 
-    async def check_balance_and_advance(self, user_data):
+    async def check_balance_and_advance(self, user_data, max_age=BALANCE_CACHE_TTL):
+        """Основной баланс и аванс аккаунта.
+
+        Результат кэшируется на max_age секунд по avito_user_id, так что кнопка
+        "Проверить баланс" и часовой обход делят одни данные; параллельные
+        вызовы для одного аккаунта ждут один общий запрос. В ответе есть
+        'fetched_at' — время получения данных.
+        """
+        key = str(user_data['avito_user_id'])
+        cached = self._balance_cache.get(key)
+        if cached and time.time() - cached['fetched_at'] < max_age:
+            return cached
+
+        task = self._balance_inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_balances(user_data))
+            self._balance_inflight[key] = task
+            task.add_done_callback(lambda t: self._balance_inflight.pop(key, None))
+        balances = await asyncio.shield(task)
+        if balances and (balances['main_balance'] is not None or balances['advance'] is not None):
+            self._balance_cache[key] = balances
+        return balances
+
+    async def _fetch_balances(self, user_data):
         token = await self.get_token(user_data['client_id'], user_data['client_secret'])
         if not token:
             return None
         
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                'Authorization': f'Bearer {token}',
-                'Content-Type': 'application/json',
-                'X-Source': 'telegram_bot'
-            }
-            
-            # Проверяем основной баланс
-            balance_url = f"https://api.avito.ru/core/v1/accounts/{user_data['avito_user_id']}/balance/"
-            balance_data = None
+        session = await http_client.session()
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Source': 'telegram_bot'
+        }
+        
+        # Проверяем основной баланс
+        async def get_main_balance():
+            balance_url = f"{AVITO_API_BASE_URL}/core/v1/accounts/{user_data['avito_user_id']}/balance/"
             try:
-                async with session.get(balance_url, headers=headers) as response:
-                    if response.status == 200:
-                        balance_data = await response.json()
+                status, data = await self.avito_request(session, 'GET', balance_url, user_data, headers=headers)
+                if status == 200:
+                    return data
             except Exception as e:
-                print(f"Error checking main balance: {e}")
+                logger.error("Error checking main balance: %s", e)
+            return None
 
-            # Проверяем аванс
-            advance_url = "https://api.avito.ru/cpa/v3/balanceInfo"
-            advance_data = None
+        # Проверяем аванс
+        async def get_advance():
+            advance_url = f"{AVITO_API_BASE_URL}/cpa/v3/balanceInfo"
             try:
-                async with session.post(advance_url, headers=headers, json={}) as response:
-                    if response.status == 200:
-                        advance_data = await response.json()
+                status, data = await self.avito_request(session, 'POST', advance_url, user_data, headers=headers, json={})
+                if status == 200:
+                    return data
             except Exception as e:
-                print(f"Error checking advance balance: {e}")
+                logger.error("Error checking advance balance: %s", e)
+            return None
 
-            return {
-                'main_balance': balance_data,
-                'advance': advance_data.get('balance', 0) / 100 if advance_data else None
-            }
+        # Оба запроса независимы, поэтому идут параллельно
+        balance_data, advance_data = await asyncio.gather(get_main_balance(), get_advance())
+
+        return {
+            'main_balance': balance_data,
+            'advance': advance_data.get('balance', 0) / 100 if advance_data else None,
+            'fetched_at': time.time()
+        }
 
     async def check_balance_periodically(self, context: ContextTypes.DEFAULT_TYPE):
-        print("\n💰 Запущена проверка балансов")
-        users = self.get_active_users()
-        print(f"📊 Проверяем баланс для {len(users)} пользователей")
+        started = time.monotonic()
+        users = self.owned_users(self.get_active_users())
+        logger.info("Balance check started", extra={'users': len(users)})
+        warnings_sent = 0
+        # Флаги уведомлений копятся за весь проход и пишутся батчами
+        updates = UserUpdateBatch(self.db, self.user_cache)
         
         for user_data in users:
             try:
@@ -582,7 +1119,7 @@ class AvitoBot:
                             f"Текущий баланс: {main_balance.get('real', 0)} ₽"
                         )
                         user_data['notified_main_balance_200'] = 1
-                        self.save_user(user_data['user_id'], user_data)
+                        updates.set(user_data['user_id'], 'notified_main_balance_200', 1)
                     
                     # Проверка аванса (при < 200 и < 100)
                     if advance_balance is not None:
@@ -592,7 +1129,7 @@ class AvitoBot:
                                 f"Текущий аванс: {advance_balance:.2f} ₽"
                             )
                             user_data['notified_advance_200'] = 1
-                            self.save_user(user_data['user_id'], user_data)
+                            updates.set(user_data['user_id'], 'notified_advance_200', 1)
                         
                         if advance_balance < 100 and not user_data.get('notified_advance_100'):
                             warning_msg.append(
@@ -600,7 +1137,7 @@ class AvitoBot:
                                 f"Текущий аванс: {advance_balance:.2f} ₽"
                             )
                             user_data['notified_advance_100'] = 1
-                            self.save_user(user_data['user_id'], user_data)
+                            updates.set(user_data['user_id'], 'notified_advance_100', 1)
                     
                     if warning_msg:
                         await context.bot.send_message(
@@ -608,66 +1145,34 @@ class AvitoBot:
                             "❗️ ВНИМАНИЕ! Низкий баланс!\n\n" + "\n\n".join(warning_msg) +
                             "\n\nПожалуйста, пополните баланс для продолжения работы с сервисом!"
                         )
-                        print(f"⚠️ Отправлено предупреждение о низком балансе пользователю {user_data['user_id']}")
+                        warnings_sent += 1
+                        logger.info("Low balance warning sent to user %s", user_data['user_id'])
                     
             except Exception as e:
-                print(f"❌ Ошибка при проверке баланса пользователя {user_data['user_id']}: {e}")
+                logger.error("Balance check failed for user %s: %s", user_data['user_id'], e)
         
-        print("✅ Проверка балансов завершена\n")
+        if len(updates):
+            try:
+                commits = updates.commit()
+                logger.info("Notification flags saved", extra={'batch_commits': commits})
+            except Exception as e:
+                logger.error("Failed to save notification flags: %s", e)
+        logger.info("Balance check finished", extra={
+            'users': len(users),
+            'warnings_sent': warnings_sent,
+            'duration': round(time.monotonic() - started, 3),
+        })
 
     async def process_successful_payment(self, user_id: str, qrc_id: str):
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
         try:
-            c.execute('BEGIN')
-            
-            # Получаем информацию о платеже
-            c.execute('''
-                UPDATE qr_payments 
-                SET status = 'succeeded', paid_at = strftime('%s','now')
-                WHERE qrc_id = ? AND user_id = ? AND status = 'pending'
-                RETURNING accounts_count
-            ''', (qrc_id, user_id))
-            
-            result = c.fetchone()
-            if result:
-                accounts_count = result[0]
-                
-                # Обновляем количество доступных аккаунтов
-                c.execute('''
-                    UPDATE users 
-                    SET paid_accounts = paid_accounts + ?
-                    WHERE user_id = ?
-                ''', (accounts_count, user_id))
-                
-                c.execute('COMMIT')
-                return True
-            
-            c.execute('ROLLBACK')
-            return False
-            
+            return self.sql.complete_qr_payment(user_id, qrc_id) is not None
         except Exception as e:
-            c.execute('ROLLBACK')
-            print(f"Error processing payment: {e}")
+            logger.error("Error processing payment: %s", e)
             return False
-        finally:
-            conn.close()
 
     async def get_available_accounts(self, user_id: str) -> int:
-        conn = sqlite3.connect(self.db_path)
-        c = conn.cursor()
-        
-        try:
-            # Получаем количество оплаченных аккаунтов
-            c.execute('SELECT paid_accounts FROM users WHERE user_id = ?', (user_id,))
-            result = c.fetchone()
-            paid_accounts = result[0] if result else 0
-            
-            # Возвращаем сумму бесплатных (3) и оплаченных аккаунтов
-            return 3 + paid_accounts
-        finally:
-            conn.close()
+        # Возвращаем сумму бесплатных (3) и оплаченных аккаунтов
+        return 3 + self.sql.get_paid_accounts(user_id)
 
     async def buy_accounts_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = [
@@ -692,21 +1197,78 @@ class AvitoBot:
             return
         
         try:
-            payment_service = PaymentService(os.getenv('TOCHKA_JWT_TOKEN'))
-            await payment_service.test_token()
+            await get_payment_service().test_token()
             await update.message.reply_text("✅ Токен работает корректно!")
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка проверки токена:\n{str(e)}")
 
+    async def queue_stats_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if str(update.message.from_user.id) != os.getenv('ADMIN_TELEGRAM_ID'):
+            await update.message.reply_text("❌ У вас нет прав для этой команды")
+            return
+
+        stats = self.reply_sender.stats()
+        depth = stats['depth']
+        await update.message.reply_text(
+            "📤 Очередь автоответов:\n\n"
+            f"Ожидают: {depth['pending']}\n"
+            f"Отправляются: {depth['sending']}\n"
+            f"Ошибки: {depth['failed']}\n\n"
+            f"Воркеров: {stats['workers']}\n"
+            f"Отправлено: {stats['sent']} ({stats['throughput']:.2f}/с)\n"
+            f"Повторов: {stats['retried']}"
+        )
+
+    async def db_stats_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if str(update.message.from_user.id) != os.getenv('ADMIN_TELEGRAM_ID'):
+            await update.message.reply_text("❌ У вас нет прав для этой команды")
+            return
+
+        stats = self.retention.stats()
+        last_run = datetime.fromtimestamp(stats['last_run']).strftime('%d.%m %H:%M') if stats['last_run'] else '—'
+        await update.message.reply_text(
+            "🗄 База данных:\n\n"
+            f"Размер: {stats['bytes'] / 1024 / 1024:.1f} МБ "
+            f"(свободных страниц: {stats['free_pages']})\n"
+            f"replied_chats: {stats['rows']} строк, в памяти: {stats['in_memory']}\n\n"
+            f"Удалено очисткой: {stats['pruned']} ({stats['prune_rate']:.0f} строк/с)\n"
+            f"Последняя очистка: {last_run}"
+        )
+
+    async def cache_stats_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if str(update.message.from_user.id) != os.getenv('ADMIN_TELEGRAM_ID'):
+            await update.message.reply_text("❌ У вас нет прав для этой команды")
+            return
+
+        stats = self.user_cache.stats()
+        await update.message.reply_text(
+            "📦 Кэш пользователей:\n\n"
+            f"Записей: {stats['size']}\n"
+            f"Попаданий: {stats['hits']}\n"
+            f"Промахов: {stats['misses']}\n"
+            f"Обновлений из Firestore: {stats['invalidations']}\n"
+            f"Hit rate: {stats['hit_rate']:.0%}"
+        )
+
 class PaymentService:
     def __init__(self, jwt_token):
         self.jwt_token = jwt_token.strip()
         if not self.jwt_token.startswith('Bearer '):
             self.jwt_token = f'Bearer {self.jwt_token}'
         
-        self.base_url = 'https://enter.tochka.com'
+        self.base_url = TOCHKA_API_BASE_URL
+        self._merchant_info = None
+        self._merchant_info_at = 0
+        self._merchant_info_lock = asyncio.Lock()
+
+    def invalidate_merchant_info(self):
         self._merchant_info = None
 
+    def _check_auth(self, status):
+        """На 401/403 сбрасываем данные мерчанта: токен или права могли смениться"""
+        if status in (401, 403):
+            self.invalidate_merchant_info()
+
     async def test_token(self):
         """Тестирует валидность токена через получение списка клиентов"""
         try:
@@ -717,73 +1279,84 @@ class PaymentService:
             
             test_url = f'{self.base_url}/open/v2/customers'
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(test_url, headers=headers) as response:
-                    response_text = await response.text()
-                    logging.info(f"Test token response status: {response.status}")
-                    logging.debug(f"Test token response: {response_text}")
-                    
-                    if response.status != 200:
-                        raise Exception(f"{response.status}: {response_text}")
-                    return True
+            session = await http_client.session()
+            async with session.get(test_url, headers=headers) as response:
+                response_text = await response.text()
+                logger.info("Test token response status: %s", response.status)
+                logger.debug("Test token response: %s", response_text)
+                
+                if response.status != 200:
+                    raise Exception(f"{response.status}: {response_text}")
+                return True
         except Exception as e:
-            logging.error(f"Token test failed: {str(e)}")
+            logger.error("Token test failed: %s", e)
             raise
 
     async def _get_customer_info(self):
-        """Получает информацию о клиенте"""
-        if self._merchant_info is not None:
+        """Получает информацию о клиенте (кэшируется на MERCHANT_INFO_TTL секунд)"""
+        if self._merchant_info is not None and time.monotonic() - self._merchant_info_at < MERCHANT_INFO_TTL:
             return self._merchant_info
 
+        # Параллельные покупки ждут один общий запрос
+        async with self._merchant_info_lock:
+            if self._merchant_info is not None and time.monotonic() - self._merchant_info_at < MERCHANT_INFO_TTL:
+                return self._merchant_info
+            return await self._fetch_customer_info()
+
+    async def _fetch_customer_info(self):
         headers = {
             'Authorization': self.jwt_token,
             'Content-Type': 'application/json'
         }
 
-        async with aiohttp.ClientSession() as session:
-            # Получаем список клиентов
-            customers_url = f'{self.base_url}/open/v2/customers'
-            async with session.get(customers_url, headers=headers) as response:
+        session = await http_client.session()
+        # Получаем список клиентов
+        customers_url = f'{self.base_url}/open/v2/customers'
+        async with session.get(customers_url, headers=headers) as response:
+            response_text = await response.text()
+            logger.debug("Customers response: %s", response_text)
+            
+            if response.status != 200:
+                self._check_auth(response.status)
+                raise Exception(f"Error getting customers: {response_text}")
+            
+            data = await response.json()
+            business_customer = next(
+                (c for c in data.get('customers', []) if c.get('customerType') == 'Business'),
+                None
+            )
+            
+            if not business_customer:
+                raise Exception("No business customer found")
+            
+            customer_code = business_customer['customerCode']
+            
+            # Получаем детальную информацию о клиенте
+            customer_url = f'{self.base_url}/open/v2/customers/{customer_code}'
+            async with session.get(
+                customer_url,
+                params={'bankCode': '044525104'},
+                headers=headers
+            ) as response:
                 response_text = await response.text()
-                logging.debug(f"Customers response: {response_text}")
+                logger.debug("Customer details response: %s", response_text)
                 
                 if response.status != 200:
-                    raise Exception(f"Error getting customers: {response_text}")
+                    self._check_auth(response.status)
+                    raise Exception(f"Error getting customer info: {response_text}")
                 
-                data = await response.json()
-                business_customer = next(
-                    (c for c in data.get('customers', []) if c.get('customerType') == 'Business'),
-                    None
-                )
+                customer_info = await response.json()
+                merchant_info = {
+                    'merchantId': customer_info.get('merchantId'),
+                    'accountId': customer_info.get('accountId')
+                }
                 
-                if not business_customer:
-                    raise Exception("No business customer found")
+                if not all(merchant_info.values()):
+                    raise Exception("Invalid merchant info received")
                 
-                customer_code = business_customer['customerCode']
-                
-                # Получаем детальную информацию о клиенте
-                customer_url = f'{self.base_url}/open/v2/customers/{customer_code}'
-                async with session.get(
-                    customer_url,
-                    params={'bankCode': '044525104'},
-                    headers=headers
-                ) as response:
-                    response_text = await response.text()
-                    logging.debug(f"Customer details response: {response_text}")
-                    
-                    if response.status != 200:
-                        raise Exception(f"Error getting customer info: {response_text}")
-                    
-                    customer_info = await response.json()
-                    self._merchant_info = {
-                        'merchantId': customer_info.get('merchantId'),
-                        'accountId': customer_info.get('accountId')
-                    }
-                    
-                    if not all(self._merchant_info.values()):
-                        raise Exception("Invalid merchant info received")
-                    
-                    return self._merchant_info
+                self._merchant_info = merchant_info
+                self._merchant_info_at = time.monotonic()
+                return merchant_info
 
     async def create_payment_qr(self, amount, accounts_count, user_id):
         """Создает QR-код для оплаты"""
@@ -803,54 +1376,48 @@ class PaymentService:
                 "redirectUrl": os.getenv("PAYMENT_SUCCESS_URL")
             }
             
-            async with aiohttp.ClientSession() as session:
-                # Регистрируем QR-код
-                async with session.post(qr_url, json=register_payload, headers=headers) as response:
+            session = await http_client.session()
+            # Регистрируем QR-код
+            async with session.post(qr_url, json=register_payload, headers=headers) as response:
+                response_text = await response.text()
+                logger.info("QR registration status: %s", response.status)
+                logger.debug("QR registration response: %s", response_text)
+                
+                if response.status != 200:
+                    self._check_auth(response.status)
+                    raise Exception(f"QR registration failed: {response_text}")
+                
+                qr_data = await response.json()
+                qrc_id = qr_data.get('qrcId')
+                
+                if not qrc_id:
+                    raise Exception("No QR code ID received")
+                
+                # Активируем QR-код с суммой
+                activate_url = f"{self.base_url}/sbp/v2/cashbox_qr_code/{qrc_id}/activate"
+                activate_payload = {
+                    "amount": int(amount * 100)  # в копейках
+                }
+                
+                async with session.post(activate_url, json=activate_payload, headers=headers) as response:
                     response_text = await response.text()
-                    logging.info(f"QR registration status: {response.status}")
-                    logging.debug(f"QR registration response: {response_text}")
+                    logger.info("QR activation status: %s", response.status)
+                    logger.debug("QR activation response: %s", response_text)
                     
                     if response.status != 200:
-                        raise Exception(f"QR registration failed: {response_text}")
-                    
-                    qr_data = await response.json()
-                    qrc_id = qr_data.get('qrcId')
-                    
-                    if not qrc_id:
-                        raise Exception("No QR code ID received")
-                    
-                    # Активируем QR-код с суммой
-                    activate_url = f"{self.base_url}/sbp/v2/cashbox_qr_code/{qrc_id}/activate"
-                    activate_payload = {
-                        "amount": int(amount * 100)  # в копейках
-                    }
-                    
-                    async with session.post(activate_url, json=activate_payload, headers=headers) as response:
-                        response_text = await response.text()
-                        logging.info(f"QR activation status: {response.status}")
-                        logging.debug(f"QR activation response: {response_text}")
-                        
-                        if response.status != 200:
-                            raise Exception(f"QR activation failed: {response_text}")
-                    
-                    # Сохраняем информацию о платеже
-                    conn = sqlite3.connect('avito_bot.db')
-                    c = conn.cursor()
-                    c.execute('''
-                        INSERT INTO qr_payments 
-                        (user_id, qrc_id, amount, accounts_count, status)
-                        VALUES (?, ?, ?, ?, 'pending')
-                    ''', (user_id, qrc_id, amount, accounts_count))
-                    conn.commit()
-                    conn.close()
-                    
-                    return {
-                        'qrc_id': qrc_id,
-                        'image': qr_data.get('image'),
-                        'amount': amount
-                    }
+                        self._check_auth(response.status)
+                        raise Exception(f"QR activation failed: {response_text}")
+                
+                # Сохраняем информацию о платеже
+                get_database().create_qr_payment(user_id, qrc_id, amount, accounts_count)
+                
+                return {
+                    'qrc_id': qrc_id,
+                    'image': qr_image_bytes(qr_data.get('image')),
+                    'amount': amount
+                }
         except Exception as e:
-            logging.error(f"Error creating QR payment: {e}")
+            logger.error("Error creating QR payment: %s", e)
             return None
 
     async def check_payment_status(self, qrc_id):
@@ -863,22 +1430,208 @@ class PaymentService:
             
             status_url = f"{self.base_url}/sbp/v2/cashbox_qr_code/{qrc_id}/payment-status"
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(status_url, headers=headers) as response:
-                    response_text = await response.text()
-                    logging.info(f"Payment status check: {response.status}")
-                    logging.debug(f"Payment status response: {response_text}")
+            session = await http_client.session()
+            async with session.get(status_url, headers=headers) as response:
+                response_text = await response.text()
+                logger.info("Payment status check: %s", response.status)
+                logger.debug("Payment status response: %s", response_text)
+                
+                if response.status != 200:
+                    self._check_auth(response.status)
+                    raise Exception(f"{response.status}: {response_text}")
                     
-                    if response.status != 200:
-                        raise Exception(f"{response.status}: {response_text}")
-                        
-                    data = await response.json()
-                    return data.get('status', 'PENDING')
+                data = await response.json()
+                return data.get('status', 'PENDING')
         except Exception as e:
-            logging.error(f"Error checking payment status: {e}")
+            logger.error("Error checking payment status: %s", e)
             return 'ERROR'
 
-bot = AvitoBot()  # Создаем глобальный экземпляр бота
+def qr_image_bytes(image):
+    """PNG QR-кода из ответа Точки: base64-строка или объект с полем content"""
+    if isinstance(image, dict):
+        image = image.get('content')
+    return base64.b64decode(image) if image else None
+
+_payment_service = None
+
+def get_payment_service() -> PaymentService:
+    """Общий PaymentService процесса: данные мерчанта не запрашиваются на каждую покупку"""
+    global _payment_service
+    if _payment_service is None:
+        _payment_service = PaymentService(os.getenv('TOCHKA_JWT_TOKEN'))
+    return _payment_service
+
+_bot = None
+_bot_lock = threading.Lock()
+
+def get_bot() -> AvitoBot:
+    """Глобальный экземпляр бота, создается при первом обращении"""
+    global _bot
+    if _bot is None:
+        with _bot_lock:
+            if _bot is None:
+                _bot = AvitoBot()
+    return _bot
+
+def __getattr__(name):
+    # Совместимость с `from bot import bot`: экземпляр создается лениво
+    if name == 'bot':
+        return get_bot()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def register_handlers(application, bot):
+    """Регистрирует одинаковый набор обработчиков для polling- и webhook-режима"""
+    # Добавляем обработчик команды проверки токена
+    application.add_handler(CommandHandler('test_token', bot.test_token_handler))
+    application.add_handler(CommandHandler('cache_stats', bot.cache_stats_handler))
+    application.add_handler(CommandHandler('queue_stats', bot.queue_stats_handler))
+    application.add_handler(CommandHandler('db_stats', bot.db_stats_handler))
+
+    conv_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler('start', bot.track_conversation(bot.start)),
+            CallbackQueryHandler(bot.track_conversation(bot.button_handler))
+        ],
+        # Шаг берется из bot.conversations, поэтому все состояния ведут в continue_conversation
+        states={
+            WAITING_CLIENT_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.continue_conversation)],
+            WAITING_CLIENT_SECRET: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.continue_conversation)],
+            WAITING_USER_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.continue_conversation)],
+            WAITING_TEMPLATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.continue_conversation)],
+            WAITING_IMAGE: [MessageHandler(filters.PHOTO, bot.continue_conversation)],  # Новый обработчик
+        },
+        fallbacks=[CommandHandler('start', bot.track_conversation(bot.start))],
+    )
+    
+    application.add_handler(conv_handler)
+    # Диалог начат другим экземпляром или до перезапуска: этот ConversationHandler о нем не знает
+    application.add_handler(MessageHandler(
+        (filters.TEXT & ~filters.COMMAND) | filters.PHOTO, bot.continue_conversation
+    ))
+    # После всех обработчиков апдейта пишем изменения состояния одной пачкой
+    application.add_handler(TypeHandler(Update, bot.flush_state), group=1)
+
+def schedule_jobs(application, bot):
+    # Добавляем логи в check_messages
+    async def check_messages_with_logs(context):
+        stats = await bot.check_messages(context)
+        # Тик планировщика частый, пишем только циклы, где кого-то опросили
+        if stats.accounts_polled or stats.errors:
+            logger.info("Poll cycle finished", extra=stats.as_dict())
+
+    # Добавляем логи в send_reminder
+    async def send_reminder(context):
+        if bot.shard is not None and not bot.shard.owns('broadcast:reminder'):
+            # Рассылку ведет один воркер из кольца, иначе пользователи получат ее N раз
+            return
+        logger.info("Reminder broadcast started")
+        reply_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Перейти к боту рассылки", url="t.me/avsender_bot")]
+        ])
+
+        async def send(user_id):
+            await context.bot.send_message(
+                user_id,
+                "Напоминаю! У нас есть бот для рассылки по чатам Avito!\n\n"
+                "🚀 С помощью @avsender_bot вы можете:\n"
+                "• Отправлять сообщения по своим чатам\n"
+                "• Настраивать фильтры по датам\n"
+                "• Добавлять изображения\n\n"
+                "👉 Переходите прямо сейчас!",
+                reply_markup=reply_markup
+            )
+
+        state = await Broadcaster(bot.sql).run('reminder', send)
+        logger.info("Reminder broadcast finished", extra={
+            'sent': state['sent'], 'failed': state['failed'], 'blocked': state['blocked'],
+        })
+
+    job_queue = application.job_queue
+    if bot.shard is not None:
+        job_queue.run_repeating(bot.refresh_shard, interval=bot.shard.heartbeat, first=0)
+    # Сроки опроса каждого аккаунта ведет bot.poll_scheduler, задача лишь часто "тикает"
+    job_queue.run_repeating(check_messages_with_logs, interval=POLL_TICK, first=10)
+    job_queue.run_repeating(send_reminder, interval=3*24*60*60, first=24*60*60)
+    reminder = bot.sql.get_broadcast('reminder')
+    if reminder and reminder['finished_at'] is None:
+        # Прерванную рассылку продолжаем вскоре после старта, не дожидаясь расписания
+        job_queue.run_once(send_reminder, when=60)
+    job_queue.run_repeating(bot.check_balance_periodically, interval=60*60, first=10)  # Проверка каждый час
+    # Очистка старых replied_chats, incremental_vacuum и ANALYZE
+    job_queue.run_repeating(bot.retention.run, interval=RETENTION_INTERVAL, first=5*60)
+    job_queue.run_repeating(bot.purge_state, interval=STATE_PURGE_INTERVAL, first=STATE_PURGE_INTERVAL)
+    # Зачисление оплаченных QR-платежей без нажатия "Проверить оплату"
+    job_queue.run_repeating(bot.payment_reconciler.run, interval=PAYMENT_RECONCILE_INTERVAL, first=30)
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, записывающий время вызовов Bot API в metrics"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        # В пути URL токен бота, в метку идет только имя метода
+        endpoint = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            metrics.http_request_errors.inc(service='telegram', endpoint=endpoint, status=type(e).__name__)
+            raise
+        metrics.http_request_seconds.observe(
+            time.perf_counter() - started, service='telegram', method=method, endpoint=endpoint
+        )
+        if status >= 400:
+            metrics.http_request_errors.inc(service='telegram', endpoint=endpoint, status=status)
+        return status, payload
+
+def build_application(bot, with_jobs=True, avito_webhook_server=True, metrics_server=True):
+    """Собирает Application с обработчиками, задачами и корректным завершением.
+
+    avito_webhook_server=False, если маршруты webhook Avito уже обслуживает
+    внешний HTTP-сервер (webhook_server.py); metrics_server=False — то же для /metrics.
+    """
+    async def on_startup(application):
+        bot.reply_sender.start()
+        if metrics_server and metrics.METRICS_PORT:
+            application.bot_data['metrics_server'] = await metrics.start_server()
+            logger.info("Metrics server listening on %s:%s", metrics.METRICS_HOST, metrics.METRICS_PORT)
+        if webhook_enabled() and avito_webhook_server:
+            receiver = AvitoWebhookReceiver(bot)
+            await receiver.start()
+            application.bot_data['avito_webhook'] = receiver
+            # Подписка идет в фоне и не задерживает старт
+            receiver.start_subscriptions()
+
+    async def on_shutdown(application):
+        receiver = application.bot_data.get('avito_webhook')
+        if receiver is not None:
+            await receiver.stop()
+        metrics_runner = application.bot_data.get('metrics_server')
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await bot.reply_sender.stop()
+        # Дописываем буферы ответов и состояния диалогов, закрываем общий пул HTTP-соединений
+        bot.replied_chats.flush()
+        bot.state.flush()
+        bot.unwatch_users()
+        if bot.shard is not None:
+            bot.shard.leave()
+        close_databases()
+        await http_client.close()
+
+    builder = (
+        Application.builder()
+        .token(os.getenv('TELEGRAM_BOT_TOKEN'))
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if os.getenv('TELEGRAM_API_BASE_URL'):
+        # Локальный Bot API сервер или заглушка для бенчмарков
+        builder = builder.base_url(os.getenv('TELEGRAM_API_BASE_URL'))
+    application = builder.build()
+    register_handlers(application, bot)
+    if with_jobs:
+        schedule_jobs(application, bot)
+    return application
 
 def main():
     if __name__ == '__main__':
@@ -899,86 +1652,22 @@ def main():
             return
         
         try:
-            # Проверяем токен при запуске
-            payment_service = PaymentService(os.getenv('TOCHKA_JWT_TOKEN'))
-            
-            bot = AvitoBot()
+            bot = get_bot()
+            if os.getenv('USER_CACHE_LISTEN', '1') == '1':
+                bot.watch_users()
             print("✅ Бот инициализирован")
             
-            application = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
-            
-            # Добавляем обработчик команды проверки токена
-            application.add_handler(CommandHandler('test_token', bot.test_token_handler))
-            
-            # Добавляем логи в check_messages
-            async def check_messages_with_logs(context):
-                print("\n🔄 Запущена проверка сообщений")
-                users = bot.get_active_users()
-                print(f"📊 Найдено активных пользователей: {len(users)}")
-                await bot.check_messages(context)
-                print("✅ Проверка сообщений завершена\n")
-
-            # Добавляем логи в send_reminder
-            async def send_reminder(context):
-                print("\n📢 Запущена отправка напоминаний")
-                conn = sqlite3.connect(bot.db_path)
-                c = conn.cursor()
-                c.execute('SELECT user_id FROM users')
-                users = c.fetchall()
-                print(f"👥 Всего пользователей для напоминания: {len(users)}")
-                conn.close()
-
-                for user in users:
-                    try:
-                        await context.bot.send_message(
-                            user[0],
-                            "Напоминаю! У нас есть бот для рассылки по чатам Avito!\n\n"
-                            "🚀 С помощью @avsender_bot вы можете:\n"
-                            "• Отправлять сообщения по своим чатам\n"
-                            "• Настраивать фильтры по датам\n"
-                            "• Добавлять изображения\n\n"
-                            "👉 Переходите прямо сейчас!",
-                            reply_markup=InlineKeyboardMarkup([
-                                [InlineKeyboardButton("Перейти к боту рассылки", url="t.me/avsender_bot")]
-                            ])
-                        )
-                        print(f"✅ Напоминание отправлено пользователю {user[0]}")
-                    except Exception as e:
-                        print(f"❌ Ошибка отправки напоминания пользователю {user[0]}: {e}")
-                        continue
-                print("✅ Отправка напоминаний завершена\n")
-
-            conv_handler = ConversationHandler(
-                entry_points=[
-                    CommandHandler('start', bot.start),
-                    CallbackQueryHandler(bot.button_handler)
-                ],
-                states={
-                    WAITING_CLIENT_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_client_id)],
-                    WAITING_CLIENT_SECRET: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_client_secret)],
-                    WAITING_USER_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_user_id)],
-                    WAITING_TEMPLATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, bot.handle_template)],
-                    WAITING_IMAGE: [MessageHandler(filters.PHOTO, bot.handle_image)],  # Новый обработчик
-                },
-                fallbacks=[CommandHandler('start', bot.start)],
-            )
-            
-            application.add_handler(conv_handler)
+            application = build_application(bot)
             print("✅ Обработчики добавлены")
-            
-            job_queue = application.job_queue
-            job_queue.run_repeating(check_messages_with_logs, interval=60, first=10)
-            job_queue.run_repeating(send_reminder, interval=3*24*60*60, first=24*60*60)
-            job_queue.run_repeating(bot.check_balance_periodically, interval=60*60, first=10)  # Проверка каждый час
             print("✅ Задачи планировщика добавлены")
             
             print("\n🚀 Бот запущен и готов к работе!")
             application.run_polling(allowed_updates=Update.ALL_TYPES)
             
         except Exception as e:
-            logging.error(f"Startup error: {e}")
+            logger.error("Startup error: %s", e)
             print(f"❌ Ошибка запуска: {e}")
             sys.exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import os
+import time
+
+from telegram.error import Forbidden, RetryAfter
+
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Telegram допускает ~30 сообщений в секунду на бота; держимся чуть ниже
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '20'))
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '500'))
+BROADCAST_MAX_RETRIES = 3
+
+
+class Broadcaster:
+    """Рассылка сообщения всем пользователям из таблицы users.
+
+    Получатели читаются порциями по user_id, сообщения уходят параллельно
+    под общим лимитом скорости. После каждой порции прогресс сохраняется в
+    таблицу broadcasts, поэтому прерванная рассылка продолжается с места
+    остановки. Заблокировавшие бота пользователи помечаются users.blocked
+    и в следующие рассылки не попадают.
+    """
+
+    def __init__(self, database, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY,
+                 chunk_size=BROADCAST_CHUNK_SIZE):
+        self.database = database
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+
+    async def run(self, name, send):
+        """send(user_id) — корутина отправки одному пользователю. Возвращает итоговое состояние"""
+        state = self.database.get_broadcast(name)
+        if state is None or state['finished_at'] is not None:
+            state = {
+                'last_user_id': None,
+                'sent': 0,
+                'failed': 0,
+                'blocked': 0,
+                'started_at': int(time.time()),
+                'finished_at': None,
+            }
+        else:
+            logger.info("Resuming broadcast %s after user %s", name, state['last_user_id'])
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            user_ids = self.database.get_user_ids_after(state['last_user_id'], self.chunk_size)
+            if not user_ids:
+                break
+
+            blocked = []
+
+            async def deliver(user_id):
+                async with semaphore:
+                    result = await self._send_one(send, user_id)
+                if result == 'sent':
+                    state['sent'] += 1
+                elif result == 'blocked':
+                    blocked.append(user_id)
+                else:
+                    state['failed'] += 1
+
+            await asyncio.gather(*(deliver(user_id) for user_id in user_ids))
+
+            if blocked:
+                self.database.mark_users_blocked(blocked)
+                state['blocked'] += len(blocked)
+            # Чекпоинт только после целиком обработанной порции
+            state['last_user_id'] = user_ids[-1]
+            self.database.save_broadcast(name, state)
+
+        state['finished_at'] = int(time.time())
+        self.database.save_broadcast(name, state)
+        return state
+
+    async def _send_one(self, send, user_id):
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            wait = self.bucket.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                await send(user_id)
+                return 'sent'
+            except RetryAfter as e:
+                # Flood control: тормозим всю рассылку, а не только этот запрос
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                self.bucket.block(retry_after)
+            except Forbidden:
+                return 'blocked'
+            except Exception as e:
+                logger.error("Broadcast to %s failed: %s", user_id, e)
+                return 'failed'
+        return 'failed'
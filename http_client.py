@@ -0,0 +1,62 @@
+import asyncio
+import os
+
+import aiohttp
+
+from metrics import aiohttp_trace_config
+
+# Базовые адреса внешних API; переопределяются для локальных заглушек (benchmarks/load.py)
+AVITO_API_BASE_URL = os.getenv('AVITO_API_BASE_URL', 'https://api.avito.ru').rstrip('/')
+TOCHKA_API_BASE_URL = os.getenv('TOCHKA_API_BASE_URL', 'https://enter.tochka.com').rstrip('/')
+
+# Настройки пула соединений для api.avito.ru и enter.tochka.com
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', '100'))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', '30'))
+HTTP_DNS_CACHE_TTL = int(os.getenv('HTTP_DNS_CACHE_TTL', '300'))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', '60'))
+HTTP_TOTAL_TIMEOUT = float(os.getenv('HTTP_TOTAL_TIMEOUT', '30'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '10'))
+
+
+class HttpClient:
+    """Одна долгоживущая aiohttp-сессия на процесс.
+
+    Соединения переиспользуются (keep-alive), поэтому TCP+TLS рукопожатие
+    с api.avito.ru и enter.tochka.com происходит один раз, а не на каждый запрос.
+    Сессия создается лениво и пересоздается, если сменился event loop
+    (например, при asyncio.run на каждый запрос в api/index.py).
+    """
+
+    def __init__(self):
+        self._session = None
+        self._loop = None
+
+    async def session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=HTTP_TOTAL_TIMEOUT,
+                sock_connect=HTTP_CONNECT_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                trace_configs=[aiohttp_trace_config()],  # Латентность запросов в metrics
+            )
+            self._loop = loop
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+
+http_client = HttpClient()  # Общий HTTP-клиент процесса
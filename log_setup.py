@@ -0,0 +1,144 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# json — одна JSON-строка на запись, text — привычный человекочитаемый формат
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+# Уровни отдельных логгеров: "bot=DEBUG,httpx=WARNING"; дополняют DEFAULT_LOGGER_LEVELS
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+# Одинаковых сообщений (по шаблону) за окно пропускается не больше LOG_SAMPLE_BURST
+LOG_SAMPLE_WINDOW = float(os.getenv('LOG_SAMPLE_WINDOW', '60'))
+LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', '20'))
+
+# HTTP-клиенты и планировщик на DEBUG/INFO пишут каждый шаг соединения
+DEFAULT_LOGGER_LEVELS = {
+    'httpx': 'WARNING',
+    'httpcore': 'WARNING',
+    'hpack': 'WARNING',
+    'apscheduler': 'WARNING',
+    'aiohttp.access': 'WARNING',
+    'telegram.ext': 'INFO',
+}
+
+# Атрибуты LogRecord, которые не считаются пользовательскими полями extra
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись в одну строку JSON: время, уровень, логгер, сообщение и поля из extra"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Ограничивает повторы: не больше burst записей одного шаблона за window секунд.
+
+    Ключ — логгер, уровень и шаблон сообщения (record.msg до подстановки
+    аргументов). Первая запись нового окна получает поле suppressed с числом
+    отброшенных повторов за прошлое окно. WARNING и выше не отбрасываются.
+    """
+
+    def __init__(self, window=LOG_SAMPLE_WINDOW, burst=LOG_SAMPLE_BURST, clock=time.monotonic):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.clock = clock
+        self._counters = {}  # key -> [начало окна, пропущено, отброшено]
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.burst <= 0:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = self.clock()
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None or now - counter[0] >= self.window:
+                if counter is not None and counter[2]:
+                    record.suppressed = counter[2]
+                if len(self._counters) > 10000:
+                    self._counters.clear()
+                self._counters[key] = [now, 1, 0]
+                return True
+            if counter[1] < self.burst:
+                counter[1] += 1
+                return True
+            counter[2] += 1
+            self.dropped += 1
+            return False
+
+
+def parse_levels(spec):
+    levels = {}
+    for item in spec.split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+_listener = None
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, levels=LOG_LEVELS, stream=None):
+    """Настраивает корневой логгер: запись в очередь на месте вызова, вывод в отдельном потоке.
+
+    Вызовы logging в event loop только кладут запись в очередь; форматирование
+    и запись в stdout делает QueueListener. Повторная настройка заменяет прежнюю.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    if fmt == 'json':
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(SamplingFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name, logger_level in {**DEFAULT_LOGGER_LEVELS, **parse_levels(levels)}.items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging():
+    """Дописывает очередь и останавливает поток вывода"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
@@ -0,0 +1,229 @@
+import bisect
+import os
+import re
+import threading
+import time
+
+from aiohttp import web
+
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+# Порт отдельного сервера /metrics в polling-режиме; 0 — не поднимать
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+CYCLE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+LAG_BUCKETS = (1, 5, 10, 15, 30, 45, 60, 90, 120, 300, 600, 1800)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {value}' for key, value in items]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # key -> [counts по корзинам, sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', bound)])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+            lines.append(f'{self.name}_bucket{labels} {count}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {count}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+poll_cycle_seconds = registry.register(Histogram(
+    'avito_poll_cycle_seconds', 'Длительность цикла check_messages', buckets=CYCLE_BUCKETS))
+http_request_seconds = registry.register(Histogram(
+    'http_request_duration_seconds', 'Время запросов к внешним API',
+    ('service', 'method', 'endpoint')))
+http_request_errors = registry.register(Counter(
+    'http_request_errors_total', 'Неуспешные ответы и сетевые ошибки внешних API',
+    ('service', 'endpoint', 'status')))
+replies_sent = registry.register(Counter(
+    'avito_replies_sent_total', 'Отправленные автоответы'))
+reply_failures = registry.register(Counter(
+    'avito_reply_failures_total', 'Неудачные попытки отправки автоответа', ('status',)))
+reply_lag_seconds = registry.register(Histogram(
+    'avito_reply_lag_seconds', 'Задержка от last_message.created до успешной отправки ответа',
+    buckets=LAG_BUCKETS))
+token_refreshes = registry.register(Counter(
+    'avito_token_refreshes_total', 'Получения нового OAuth-токена Avito', ('result',)))
+
+
+_ID_SEGMENT = re.compile(r'^(?=.*\d)[\w\-~.:]+$')
+_VERSION_SEGMENT = re.compile(r'^v\d+(\.\d+)*$')
+
+
+def endpoint_label(path):
+    """Путь без идентификаторов, чтобы не плодить ряды: /accounts/123/chats -> /accounts/:id/chats"""
+    return '/'.join(':id' if _ID_SEGMENT.match(part) and not _VERSION_SEGMENT.match(part) else part
+                    for part in path.split('/'))
+
+
+def service_label(host):
+    if not host:
+        return 'other'
+    if 'avito' in host:
+        return 'avito'
+    if 'tochka' in host:
+        return 'tochka'
+    if 'telegram' in host:
+        return 'telegram'
+    return host
+
+
+def aiohttp_trace_config():
+    """TraceConfig для общей aiohttp-сессии: время и ошибки всех запросов к Avito и Точке"""
+    import aiohttp
+
+    async def on_request_start(session, context, params):
+        context.started = time.perf_counter()
+
+    async def on_request_end(session, context, params):
+        url = params.url
+        service = service_label(url.host)
+        endpoint = endpoint_label(url.path)
+        http_request_seconds.observe(
+            time.perf_counter() - context.started,
+            service=service, method=params.method, endpoint=endpoint,
+        )
+        if params.response.status >= 400:
+            http_request_errors.inc(service=service, endpoint=endpoint, status=params.response.status)
+
+    async def on_request_exception(session, context, params):
+        url = params.url
+        http_request_errors.inc(
+            service=service_label(url.host), endpoint=endpoint_label(url.path),
+            status=type(params.exception).__name__,
+        )
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+async def handle_metrics(request):
+    return web.Response(
+        text=registry.render(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+    )
+
+
+def add_routes(app):
+    app.router.add_get('/metrics', handle_metrics)
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Отдельный сервер /metrics для polling-режима. Возвращает AppRunner для остановки"""
+    app = web.Application()
+    add_routes(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_RECONCILE_INTERVAL = int(os.getenv('PAYMENT_RECONCILE_INTERVAL', '30'))
+PAYMENT_RECONCILE_CONCURRENCY = int(os.getenv('PAYMENT_RECONCILE_CONCURRENCY', '10'))
+PAYMENT_RECONCILE_BATCH = 100
+# Сколько живет QR-код: после этого неоплаченный платеж помечается expired
+PAYMENT_QR_LIFETIME = int(os.getenv('PAYMENT_QR_LIFETIME', str(72 * 60 * 60)))
+# Интервал между проверками одного платежа растет от base до cap
+PAYMENT_CHECK_BASE = 30
+PAYMENT_CHECK_CAP = 30 * 60
+
+
+def next_check_delay(attempts, base=PAYMENT_CHECK_BASE, cap=PAYMENT_CHECK_CAP):
+    return min(cap, base * 2 ** attempts)
+
+
+class PaymentReconciler:
+    """Фоновая сверка ожидающих платежей из qr_payments со статусами в Точке.
+
+    Проход читает платежи порциями по id, проверяет статус с ограниченным
+    параллелизмом и зачисляет оплаченные через process_successful_payment.
+    Неоплаченный платеж проверяется снова с растущим интервалом, а после
+    срока жизни QR-кода помечается expired.
+    """
+
+    def __init__(self, bot, database, payment_service_factory,
+                 concurrency=PAYMENT_RECONCILE_CONCURRENCY, batch_size=PAYMENT_RECONCILE_BATCH,
+                 lifetime=PAYMENT_QR_LIFETIME):
+        self.bot = bot
+        self.database = database
+        self.payment_service_factory = payment_service_factory
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.lifetime = lifetime
+        self.checked = 0
+        self.completed = 0
+        self.expired = 0
+
+    async def run(self, context=None):
+        """Один проход сверки. Возвращает число зачисленных платежей"""
+        now = time.time()
+        self.expired += self.database.expire_qr_payments(int(now - self.lifetime))
+
+        payment_service = self.payment_service_factory()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        completed = 0
+        last_id = 0
+
+        async def reconcile(payment):
+            nonlocal completed
+            async with semaphore:
+                if await self._reconcile_one(payment_service, payment, context):
+                    completed += 1
+
+        while True:
+            payments = self.database.get_due_payments(now, last_id, self.batch_size)
+            if not payments:
+                break
+            await asyncio.gather(*(reconcile(payment) for payment in payments))
+            last_id = payments[-1]['id']
+
+        self.completed += completed
+        return completed
+
+    async def _reconcile_one(self, payment_service, payment, context):
+        self.checked += 1
+        status = await payment_service.check_payment_status(payment['qrc_id'])
+        if status != 'SUCCESS':
+            # PENDING или ERROR: проверим позже, каждый раз реже
+            delay = next_check_delay(payment['check_attempts'])
+            self.database.reschedule_payment_check(payment['qrc_id'], time.time() + delay)
+            return False
+
+        if not await self.bot.process_successful_payment(payment['user_id'], payment['qrc_id']):
+            # Платеж уже зачислен (например, по кнопке "Проверить оплату")
+            return False
+
+        logger.info("Payment %s of user %s reconciled", payment['qrc_id'], payment['user_id'])
+        if context is not None:
+            try:
+                await context.bot.send_message(
+                    payment['user_id'],
+                    "✅ Оплата прошла успешно!\n\nДополнительные аккаунты активированы."
+                )
+            except Exception as e:
+                logger.error("Failed to notify user %s about payment: %s", payment['user_id'], e)
+        return True
+
+    def stats(self):
+        return {
+            'checked': self.checked,
+            'completed': self.completed,
+            'expired': self.expired,
+        }
@@ -0,0 +1,110 @@
+import heapq
+import os
+import time
+
+# Интервалы опроса одного аккаунта: активные опрашиваются раз в
+# POLL_MIN_INTERVAL, простаивающие реже, вплоть до POLL_MAX_INTERVAL
+POLL_MIN_INTERVAL = float(os.getenv('POLL_MIN_INTERVAL', '30'))
+POLL_MAX_INTERVAL = float(os.getenv('POLL_MAX_INTERVAL', '900'))
+POLL_BACKOFF = float(os.getenv('POLL_BACKOFF', '2'))
+# Как часто планировщик проверяет, кому пора на опрос
+POLL_TICK = float(os.getenv('POLL_TICK', '10'))
+
+
+class AdaptivePollScheduler:
+    """Планировщик опроса с собственным сроком для каждого аккаунта.
+
+    Сроки лежат в куче (due_at, seq, user_id). После опроса без новых
+    сообщений интервал аккаунта растет в POLL_BACKOFF раз до max_interval,
+    любое новое сообщение возвращает его к min_interval.
+    Устаревшие записи кучи не удаляются, а пропускаются по seq.
+    """
+
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL,
+                 backoff=POLL_BACKOFF, clock=time.monotonic):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.clock = clock
+        self._heap = []
+        self._seq = 0
+        self._accounts = {}  # user_id -> состояние аккаунта
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def _push(self, user_id, due_at):
+        self._seq += 1
+        state = self._accounts[user_id]
+        state['due_at'] = due_at
+        state['seq'] = self._seq
+        heapq.heappush(self._heap, (due_at, self._seq, user_id))
+
+    def sync(self, users):
+        """Приводит набор аккаунтов к списку активных пользователей"""
+        now = self.clock()
+        current = {user_data['user_id']: user_data for user_data in users}
+        for user_id in list(self._accounts):
+            if user_id not in current:
+                del self._accounts[user_id]
+        for user_id, user_data in current.items():
+            state = self._accounts.get(user_id)
+            if state is None:
+                # Новый аккаунт опрашиваем сразу
+                self._accounts[user_id] = {
+                    'user_data': user_data,
+                    'interval': self.min_interval,
+                    'last_message': 0,
+                }
+                self._push(user_id, now)
+            else:
+                state['user_data'] = user_data
+
+    def due(self):
+        """Забирает аккаунты, которым пора на опрос"""
+        now = self.clock()
+        ready = []
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, user_id = heapq.heappop(self._heap)
+            state = self._accounts.get(user_id)
+            if state is None or state['seq'] != seq:
+                continue
+            state['seq'] = None  # В работе, пока не будет record()
+            ready.append(state['user_data'])
+        return ready
+
+    def record(self, user_id, last_message_time=0):
+        """Планирует следующий опрос по результату текущего"""
+        state = self._accounts.get(user_id)
+        if state is None:
+            return
+        active = state.pop('active', False)
+        if last_message_time > state['last_message']:
+            state['last_message'] = last_message_time
+            state['interval'] = self.min_interval
+        elif active:
+            # mark_active() во время опроса: следующий опрос через min_interval, без backoff
+            state['interval'] = self.min_interval
+        else:
+            state['interval'] = min(state['interval'] * self.backoff, self.max_interval)
+        self._push(user_id, self.clock() + state['interval'])
+
+    def mark_active(self, user_id):
+        """Активность извне (например, событие webhook): вернуть быстрый интервал"""
+        state = self._accounts.get(user_id)
+        if state is None:
+            return
+        state['interval'] = self.min_interval
+        if state['seq'] is not None:
+            self._push(user_id, min(state['due_at'], self.clock() + self.min_interval))
+        else:
+            # Аккаунт сейчас опрашивается: срок назначит record(), он учтет отметку
+            state['active'] = True
+
+    def next_due_in(self):
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - self.clock())
+
+    def intervals(self):
+        return {user_id: state['interval'] for user_id, state in self._accounts.items()}
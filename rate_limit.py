@@ -0,0 +1,117 @@
+import asyncio
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+# Лимиты запросов к API Avito: на весь процесс и на один аккаунт (запросов в секунду)
+AVITO_RATE_LIMIT = float(os.getenv('AVITO_RATE_LIMIT', '50'))
+AVITO_ACCOUNT_RATE_LIMIT = float(os.getenv('AVITO_ACCOUNT_RATE_LIMIT', '5'))
+# Повторы при 429/5xx: экспоненциальная задержка с jitter
+AVITO_MAX_RETRIES = int(os.getenv('AVITO_MAX_RETRIES', '3'))
+BACKOFF_BASE = float(os.getenv('AVITO_BACKOFF_BASE', '0.5'))
+BACKOFF_CAP = float(os.getenv('AVITO_BACKOFF_CAP', '30'))
+
+
+class RetryLater(Exception):
+    """Сервер просит подождать дольше, чем разумно ждать внутри запроса.
+
+    Вызывающий откладывает работу целиком (например, очередь ответов
+    переносит задание на retry_after секунд), а не спит на месте.
+    """
+
+    def __init__(self, status, retry_after):
+        super().__init__(f"HTTP {status}, retry after {retry_after:.0f} s")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.clock = clock
+        self._tokens = self.capacity
+        self._updated_at = clock()
+        self._blocked_until = 0.0
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        return now
+
+    def reserve(self):
+        """Занимает токен и возвращает, сколько секунд нужно подождать перед запросом"""
+        now = self._refill()
+        self._tokens -= 1
+        wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+        return max(wait, self._blocked_until - now)
+
+    def block(self, seconds):
+        """Не выдавать токены seconds секунд (Retry-After от сервера)"""
+        self._blocked_until = max(self._blocked_until, self.clock() + seconds)
+
+    def blocked_for(self):
+        """Сколько секунд еще действует block()"""
+        return max(0.0, self._blocked_until - self.clock())
+
+
+class RateLimiter:
+    """Общий лимит на процесс плюс отдельный лимит на каждый аккаунт"""
+
+    def __init__(self, rate=AVITO_RATE_LIMIT, account_rate=AVITO_ACCOUNT_RATE_LIMIT):
+        self.account_rate = account_rate
+        self.global_bucket = TokenBucket(rate)
+        self._accounts = {}
+        self.throttled = 0
+
+    def _bucket(self, account):
+        bucket = self._accounts.get(account)
+        if bucket is None:
+            bucket = self._accounts[account] = TokenBucket(self.account_rate)
+        return bucket
+
+    async def acquire(self, account=None, max_wait=None):
+        """Ждет своей очереди. Если аккаунт приостановлен дольше max_wait, бросает RetryLater"""
+        if account is not None and max_wait is not None:
+            blocked = self._bucket(account).blocked_for()
+            if blocked > max_wait:
+                raise RetryLater(429, blocked)
+        wait = self.global_bucket.reserve()
+        if account is not None:
+            wait = max(wait, self._bucket(account).reserve())
+        if wait > 0:
+            self.throttled += 1
+            await asyncio.sleep(wait)
+
+    def pause(self, account, seconds):
+        if account is None:
+            self.global_bucket.block(seconds)
+        else:
+            self._bucket(account).block(seconds)
+
+
+def parse_retry_after(value):
+    """Retry-After в секундах: число или HTTP-дата. None, если заголовка нет или он кривой"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Full jitter: случайная задержка от 0 до base * 2**attempt, но не больше cap"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def should_retry(status):
+    return status == 429 or status >= 500
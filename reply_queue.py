@@ -0,0 +1,256 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+import metrics
+from rate_limit import backoff_delay
+
+logger = logging.getLogger(__name__)
+
+REPLY_WORKERS = int(os.getenv('REPLY_WORKERS', '10'))
+# Сколько секунд задание числится за воркером; после падения процесса
+# оно снова становится доступным по истечении аренды
+REPLY_LEASE = float(os.getenv('REPLY_LEASE', '120'))
+REPLY_MAX_ATTEMPTS = int(os.getenv('REPLY_MAX_ATTEMPTS', '5'))
+# Отправленные задания хранятся сутки, чтобы повторный enqueue был no-op
+REPLY_SENT_RETENTION = 24 * 60 * 60
+# Через сколько секунд неудавшийся чат можно снова поставить в очередь
+REPLY_FAILED_COOLDOWN = 60 * 60
+IDLE_WAIT = 1.0
+
+
+class ReplyQueue:
+    """Персистентная очередь исходящих автоответов в таблице reply_queue.
+
+    Одна строка на (user_id, chat_id): повторная постановка того же чата
+    игнорируется. Задание берется в работу с арендой (status='sending',
+    available_at = конец аренды) и подтверждается только после успешной
+    отправки, поэтому падение процесса не теряет решенные ответы.
+    Номер попытки (attempts) служит токеном аренды: ack/retry/fail/extend
+    меняют строку, только если задание все еще за этой попыткой, поэтому
+    воркер с истекшей арендой не перетрет результат того, кто ее перехватил.
+    У одного аккаунта в работе не больше одного задания: иначе все воркеры
+    разбирали бы страницу чатов одного продавца и ждали его лимит запросов.
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    def enqueue(self, user_id, chat_id, payload: dict) -> bool:
+        """Ставит ответ в очередь. False, если чат уже в очереди или недавно обработан"""
+        now = time.time()
+        cursor = self.database.execute('''
+            INSERT INTO reply_queue
+            (user_id, chat_id, payload, status, attempts, created_at, available_at)
+            VALUES (?, ?, ?, 'pending', 0, ?, ?)
+            ON CONFLICT (user_id, chat_id) DO UPDATE
+            SET payload = excluded.payload, status = 'pending', attempts = 0,
+                created_at = excluded.created_at, available_at = excluded.available_at,
+                finished_at = NULL, last_error = NULL
+            WHERE reply_queue.status = 'failed' AND reply_queue.finished_at < ?
+        ''', (str(user_id), str(chat_id), json.dumps(payload, ensure_ascii=False), now, now,
+              now - REPLY_FAILED_COOLDOWN))
+        return cursor.rowcount > 0
+
+    def claim(self, limit=1, lease=REPLY_LEASE):
+        now = time.time()
+        with self.database.transaction() as conn:
+            rows = conn.execute('''
+                UPDATE reply_queue
+                SET status = 'sending', attempts = attempts + 1, available_at = ?
+                WHERE id IN (
+                    SELECT id FROM reply_queue AS job
+                    WHERE status IN ('pending', 'sending') AND available_at <= ?
+                        AND NOT EXISTS (
+                            SELECT 1 FROM reply_queue AS busy
+                            WHERE busy.user_id = job.user_id
+                                AND busy.status = 'sending' AND busy.available_at > ?
+                        )
+                    ORDER BY available_at
+                    LIMIT ?
+                )
+                RETURNING id, user_id, chat_id, payload, attempts, created_at
+            ''', (now + lease, now, now, limit)).fetchall()
+        return [
+            {
+                'id': row[0],
+                'user_id': row[1],
+                'chat_id': row[2],
+                'payload': json.loads(row[3]),
+                'attempts': row[4],
+                'created_at': row[5],
+            }
+            for row in rows
+        ]
+
+    def _update_held(self, job, assignments, params):
+        """UPDATE задания, если аренда все еще за этой попыткой. True, если строка изменена"""
+        cursor = self.database.execute(
+            f"UPDATE reply_queue SET {assignments} WHERE id = ? AND attempts = ? AND status = 'sending'",
+            (*params, job['id'], job['attempts'])
+        )
+        return cursor.rowcount > 0
+
+    def extend(self, job, lease=REPLY_LEASE):
+        """Продлевает аренду задания, пока идет отправка"""
+        return self._update_held(job, 'available_at = ?', (time.time() + lease,))
+
+    def ack(self, job):
+        return self._update_held(job, "status = 'sent', finished_at = ?, last_error = NULL", (time.time(),))
+
+    def retry(self, job, delay, error):
+        return self._update_held(job, "status = 'pending', available_at = ?, last_error = ?",
+                                 (time.time() + delay, str(error)))
+
+    def fail(self, job, error):
+        return self._update_held(job, "status = 'failed', finished_at = ?, last_error = ?",
+                                 (time.time(), str(error)))
+
+    def purge_sent(self, older_than=REPLY_SENT_RETENTION):
+        cursor = self.database.execute(
+            "DELETE FROM reply_queue WHERE status = 'sent' AND finished_at < ?",
+            (time.time() - older_than,)
+        )
+        return cursor.rowcount
+
+    def depth(self):
+        """Число заданий по статусам"""
+        rows = self.database.fetchall('SELECT status, COUNT(*) FROM reply_queue GROUP BY status')
+        counts = {'pending': 0, 'sending': 0, 'sent': 0, 'failed': 0}
+        counts.update(dict(rows))
+        return counts
+
+
+class ReplySender:
+    """Пул асинхронных воркеров, разбирающих ReplyQueue"""
+
+    def __init__(self, bot, queue, workers=REPLY_WORKERS, max_attempts=REPLY_MAX_ATTEMPTS, lease=REPLY_LEASE):
+        self.bot = bot
+        self.queue = queue
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self._tasks = []
+        self._wakeup = asyncio.Event()
+        self._running = False
+        self._started_at = None
+        self._last_purge = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def notify(self):
+        """Будит воркеров после постановки нового задания"""
+        self._wakeup.set()
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._started_at = time.monotonic()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        self._running = False
+        self._wakeup.set()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        errors = 0
+        while self._running:
+            try:
+                jobs = self.queue.claim(1, self.lease)
+                if not jobs:
+                    self._purge_sent()
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), IDLE_WAIT)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await self._process(jobs[0])
+                errors = 0
+            except Exception as e:
+                # Например, "database is locked" при VACUUM или общем файле воркеров:
+                # упавший воркер пул бы уже не вернул. Взятое задание вернется по аренде
+                errors += 1
+                logger.error("Reply worker error: %s", e)
+                await asyncio.sleep(backoff_delay(errors))
+
+    async def _process(self, job):
+        error = None
+        try:
+            status = await self._send(job)
+        except Exception as e:
+            status = None
+            error = e
+            metrics.reply_failures.inc(status=type(e).__name__)
+        else:
+            if status is None:
+                # Ответ больше не нужен: пользователь удален или выключил автоответ
+                if self.queue.fail(job, 'cancelled'):
+                    await self.bot.release_queued_reply(job)
+                return
+            error = f"HTTP {status}"
+
+        if status == 200:
+            if not self.queue.ack(job):
+                logger.warning("Reply to chat %s sent after its lease expired", job['chat_id'])
+            self.sent += 1
+            return
+
+        # 4xx, кроме 429, повторять бессмысленно
+        permanent = status is not None and 400 <= status < 500 and status != 429
+        if permanent or job['attempts'] >= self.max_attempts:
+            if self.queue.fail(job, error):
+                await self.bot.release_queued_reply(job)
+            self.failed += 1
+            logger.error("Reply to chat %s failed: %s", job['chat_id'], error)
+        else:
+            # RetryLater: сервер назвал срок, раньше которого пробовать бесполезно
+            delay = max(backoff_delay(job['attempts']), getattr(error, 'retry_after', 0))
+            self.queue.retry(job, delay, error)
+            self.retried += 1
+
+    async def _send(self, job):
+        """send_queued_reply, пока фоновая задача продлевает аренду.
+
+        Картинка, текст и повторы с Retry-After могут занять дольше одной
+        аренды; без продления задание взял бы другой воркер и ответ ушел бы дважды.
+        """
+        keeper = asyncio.create_task(self._keep_lease(job))
+        try:
+            return await self.bot.send_queued_reply(job)
+        finally:
+            keeper.cancel()
+
+    async def _keep_lease(self, job):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                if not self.queue.extend(job, self.lease):
+                    return
+            except Exception as e:
+                # Следующая попытка продления будет через треть аренды, запас есть
+                logger.warning("Failed to extend lease of reply to chat %s: %s", job['chat_id'], e)
+
+    def _purge_sent(self):
+        now = time.monotonic()
+        if now - self._last_purge > 60 * 60:
+            self._last_purge = now
+            self.queue.purge_sent()
+
+    def stats(self):
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0
+        return {
+            'workers': len(self._tasks),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'throughput': self.sent / elapsed if elapsed else 0.0,
+            'depth': self.queue.depth(),
+        }
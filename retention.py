@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Сколько дней помнить, что в чат уже отвечали
+REPLIED_RETENTION_DAYS = float(os.getenv('REPLIED_RETENTION_DAYS', '90'))
+# Очистка идет маленькими транзакциями, чтобы не держать блокировку записи
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '1000'))
+RETENTION_MAX_BATCHES = int(os.getenv('RETENTION_MAX_BATCHES', '100'))
+RETENTION_INTERVAL = int(os.getenv('RETENTION_INTERVAL', str(60 * 60)))
+# Сколько свободных страниц отдавать за один incremental_vacuum
+VACUUM_PAGES = int(os.getenv('VACUUM_PAGES', '2000'))
+
+
+class RepliedChatRetention:
+    """Ограничивает рост replied_chats.
+
+    Ответы старше horizon удаляются порциями по batch_size строк (по индексу
+    replied_at) и убираются из RepliedChatIndex; между порциями управление
+    возвращается event loop. Вместе с ними забываются закрепленные ответы
+    в chat_state (при шардировании через Firestore). После очистки освобожденные страницы отдаются
+    через incremental_vacuum, а статистика планировщика обновляется ANALYZE.
+    """
+
+    def __init__(self, database, index, chat_state=None, retention_days=REPLIED_RETENTION_DAYS,
+                 batch_size=RETENTION_BATCH_SIZE, max_batches=RETENTION_MAX_BATCHES):
+        self.database = database
+        self.index = index
+        self.chat_state = chat_state
+        self.horizon = retention_days * 24 * 60 * 60
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.pruned = 0
+        self.prune_seconds = 0.0
+        self.last_run = None
+        self._conversion_reported = False
+
+    async def prune(self):
+        """Одна очистка: не больше max_batches порций. Возвращает число удаленных строк"""
+        before = int(time.time() - self.horizon)
+        started = time.monotonic()
+        deleted = 0
+        for _ in range(self.max_batches):
+            rows = self.database.prune_replied_chats(before, self.batch_size)
+            if rows:
+                self.index.discard(rows)
+                deleted += len(rows)
+            if len(rows) < self.batch_size:
+                break
+            await asyncio.sleep(0)
+        if self.chat_state is not None:
+            await asyncio.to_thread(self.chat_state.purge_replies, before)
+        self.pruned += deleted
+        self.prune_seconds += time.monotonic() - started
+        return deleted
+
+    def compact(self, deleted):
+        """incremental_vacuum и ANALYZE после очистки"""
+        size = self.database.size_stats()
+        if size['auto_vacuum'] != 2:
+            # Полный VACUUM держит блокировку всей базы, поэтому сами его не запускаем
+            if not self._conversion_reported:
+                self._conversion_reported = True
+                logger.warning("Database was created without auto_vacuum=INCREMENTAL, freed pages stay in the file; "
+                               "run `python retention.py --vacuum` once while the bot is stopped")
+        elif size['free_pages']:
+            self.database.incremental_vacuum(VACUUM_PAGES)
+        if deleted:
+            self.database.analyze('replied_chats')
+
+    async def run(self, context=None):
+        deleted = await self.prune()
+        self.compact(deleted)
+        self.last_run = time.time()
+        if deleted:
+            logger.info("Pruned %s replied_chats rows older than %.0f days", deleted, self.horizon / 86400)
+        return deleted
+
+    def stats(self):
+        return {
+            'rows': self.database.count_replied_chats(),
+            'in_memory': len(self.index),
+            'pruned': self.pruned,
+            'prune_rate': self.pruned / self.prune_seconds if self.prune_seconds else 0.0,
+            'last_run': self.last_run,
+            **self.database.size_stats(),
+        }
+
+
+def convert_to_incremental(database):
+    """Переводит базу, созданную до auto_vacuum=INCREMENTAL, в этот режим.
+
+    Полный VACUUM переписывает файл и все это время держит блокировку,
+    поэтому это ручная разовая операция при остановленном боте, а не часть задачи.
+    Возвращает размер базы до и после.
+    """
+    before = database.size_stats()
+    if before['auto_vacuum'] != 2:
+        # Database при подключении уже выставил auto_vacuum=INCREMENTAL; VACUUM его применяет
+        database.vacuum()
+    return before, database.size_stats()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from storage import get_database
+
+    parser = argparse.ArgumentParser(description='Обслуживание replied_chats и файла базы')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='разово перевести базу в auto_vacuum=INCREMENTAL (бот должен быть остановлен)')
+    args = parser.parse_args()
+    if not args.vacuum:
+        parser.print_help()
+    else:
+        before, after = convert_to_incremental(get_database())
+        print(f"auto_vacuum: {before['auto_vacuum']} -> {after['auto_vacuum']}, "
+              f"размер: {before['bytes'] / 1024 / 1024:.1f} -> {after['bytes'] / 1024 / 1024:.1f} МБ")
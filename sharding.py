@@ -0,0 +1,342 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+# Где воркеры отмечаются: '' — шардирование выключено, 'sqlite' или 'firestore'
+SHARD_BACKEND = os.getenv('SHARD_BACKEND', '').lower()
+WORKER_ID = os.getenv('WORKER_ID') or f'{socket.gethostname()}-{os.getpid()}'
+# Воркер считается живым, пока его heartbeat не старше WORKER_TTL секунд
+WORKER_HEARTBEAT = float(os.getenv('WORKER_HEARTBEAT', '15'))
+WORKER_TTL = float(os.getenv('WORKER_TTL', '45'))
+# Виртуальных узлов на воркер: сглаживает неравномерность кольца
+SHARD_VNODES = 64
+# Через сколько секунд неотправленный закрепленный ответ может перехватить другой
+# воркер: задание лежит в локальной очереди машины, которая могла пропасть навсегда
+REPLY_CLAIM_TTL = float(os.getenv('REPLY_CLAIM_TTL', '3600'))
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Консистентное хэширование: при смене состава уходит ~1/N аккаунтов"""
+
+    def __init__(self, workers, vnodes=SHARD_VNODES):
+        self.workers = tuple(sorted(workers))
+        points = sorted(
+            (_hash(f'{worker}#{index}'), worker)
+            for worker in self.workers
+            for index in range(vnodes)
+        )
+        self._keys = [point for point, _ in points]
+        self._owners = [worker for _, worker in points]
+
+    def owner(self, key):
+        if not self._keys:
+            return None
+        index = bisect.bisect(self._keys, _hash(str(key))) % len(self._keys)
+        return self._owners[index]
+
+
+class SqliteMembership:
+    """Реестр воркеров в таблице workers общего файла SQLite (несколько процессов на одной машине)"""
+
+    def __init__(self, database):
+        self.database = database
+
+    def heartbeat(self, worker_id, now):
+        self.database.heartbeat_worker(worker_id, now)
+
+    def live_workers(self, since):
+        return self.database.get_live_workers(since)
+
+    def leave(self, worker_id):
+        self.database.remove_worker(worker_id)
+
+    def purge(self, before):
+        self.database.purge_dead_workers(before)
+
+
+class FirestoreMembership:
+    """Реестр воркеров в коллекции workers Firestore (несколько машин).
+
+    Отметки чатов и закрепленные ответы при этом лежат в FirestoreChatState,
+    поэтому новый владелец аккаунта продолжает с того же места.
+    """
+
+    def __init__(self, db_factory):
+        # Firestore-клиент создается лениво ботом, поэтому берем его через функцию
+        self.db_factory = db_factory
+
+    def _collection(self):
+        return self.db_factory().collection('workers')
+
+    def heartbeat(self, worker_id, now):
+        self._collection().document(worker_id).set({'heartbeat_at': now}, merge=True)
+
+    def live_workers(self, since):
+        return [doc.id for doc in self._collection().where('heartbeat_at', '>=', since).stream()]
+
+    def leave(self, worker_id):
+        self._collection().document(worker_id).delete()
+
+    def purge(self, before):
+        for doc in self._collection().where('heartbeat_at', '<', before).stream():
+            doc.reference.delete()
+
+
+class SqliteChatState:
+    """Отметки чатов в chat_watermarks локального SQLite.
+
+    Воркеры одной машины делят файл базы, поэтому отметки у них общие, а
+    повторную постановку чата отсекает уникальная строка reply_queue:
+    отдельное закрепление ответа не нужно.
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    # Методы опроса — корутины, чтобы их можно было ждать одинаково с
+    # FirestoreChatState; локальный SQLite отвечает сразу, без потока
+
+    async def get_cursor(self, user_id):
+        return self.database.get_chat_cursor(user_id)
+
+    async def save_cursor(self, user_id, watermark, resume_offset=0, pass_latest=0, resume_before=0, resume_chat=None):
+        self.database.save_chat_cursor(user_id, watermark, resume_offset, pass_latest, resume_before, resume_chat)
+
+    async def claim_reply(self, user_id, chat_id, payload):
+        return True
+
+    async def confirm_reply(self, user_id, chat_id):
+        pass
+
+    async def release_reply(self, user_id, chat_id):
+        pass
+
+    def reclaim_replies(self, owns):
+        return []
+
+    def purge_replies(self, before):
+        return 0
+
+
+class FirestoreChatState:
+    """Отметки чатов и закрепленные ответы в Firestore, общие для всех машин.
+
+    Перед постановкой ответа в свою очередь воркер создает документ
+    reply_claims/{user_id}:{chat_id}. create() не перезаписывает существующий
+    документ, поэтому если при передаче аккаунта чат увидят оба воркера,
+    ответит только один. Проваленный или отмененный ответ освобождается.
+
+    Само задание лежит в SQLite машины, которая закрепила ответ. Если она
+    пропала вместе с диском, закрепление не отправленного ответа истекает
+    через ttl (expires_at), и владелец аккаунта ставит ответ из документа
+    в свою очередь. После отправки expires_at удаляется: такой ответ не
+    перехватывается до очистки purge_replies.
+
+    Клиент Firestore синхронный, поэтому корутины уводят запросы в поток:
+    иначе каждый запрос останавливал бы весь цикл событий вместе с
+    параллельным опросом остальных аккаунтов.
+    """
+
+    def __init__(self, db_factory, ttl=REPLY_CLAIM_TTL):
+        self.db_factory = db_factory
+        self.ttl = ttl
+
+    def _collection(self, name):
+        return self.db_factory().collection(name)
+
+    async def get_cursor(self, user_id):
+        return await asyncio.to_thread(self._get_cursor, user_id)
+
+    def _get_cursor(self, user_id):
+        doc = self._collection('chat_watermarks').document(str(user_id)).get()
+        if not doc.exists:
+            return 0, 0, 0, 0, None
+        data = doc.to_dict()
+        return (data.get('last_message_created', 0), data.get('resume_offset', 0), data.get('pass_latest', 0),
+                data.get('resume_before', 0), data.get('resume_chat'))
+
+    async def save_cursor(self, user_id, watermark, resume_offset=0, pass_latest=0, resume_before=0, resume_chat=None):
+        await asyncio.to_thread(self._save_cursor, user_id, {
+            'last_message_created': watermark,
+            'resume_offset': resume_offset,
+            'pass_latest': pass_latest,
+            'resume_before': resume_before,
+            'resume_chat': resume_chat,
+        })
+
+    def _save_cursor(self, user_id, cursor):
+        """Как в SQLite, отметка только растет: при передаче аккаунта прежний
+        владелец может дописать свой проход уже после нового"""
+        from firebase_admin import firestore
+
+        db = self.db_factory()
+        ref = db.collection('chat_watermarks').document(str(user_id))
+
+        @firestore.transactional
+        def write(transaction):
+            snapshot = ref.get(transaction=transaction)
+            if snapshot.exists:
+                current = snapshot.to_dict().get('last_message_created', 0)
+                cursor['last_message_created'] = max(current, cursor['last_message_created'])
+            transaction.set(ref, cursor)
+
+        write(db.transaction())
+
+    def _claim(self, user_id, chat_id):
+        return self._collection('reply_claims').document(f'{user_id}:{chat_id}')
+
+    async def claim_reply(self, user_id, chat_id, payload):
+        """True, если ответ в чат закреплен за этим воркером"""
+        return await asyncio.to_thread(self._claim_reply, user_id, chat_id, payload)
+
+    def _claim_reply(self, user_id, chat_id, payload):
+        from google.api_core.exceptions import AlreadyExists
+
+        now = time.time()
+        try:
+            self._claim(user_id, chat_id).create({
+                'user_id': str(user_id),
+                'chat_id': str(chat_id),
+                'payload': payload,
+                'claimed_at': now,
+                'expires_at': now + self.ttl,
+            })
+        except AlreadyExists:
+            snapshot = self._claim(user_id, chat_id).get()
+            expires_at = snapshot.to_dict().get('expires_at') if snapshot.exists else None
+            return expires_at is not None and expires_at < now and self._take_over(snapshot, payload)
+        return True
+
+    def _take_over(self, snapshot, payload):
+        """Перехватывает истекшее закрепление. False, если его успел обновить другой воркер"""
+        from google.api_core.exceptions import FailedPrecondition
+
+        now = time.time()
+        try:
+            snapshot.reference.update(
+                {'payload': payload, 'claimed_at': now, 'expires_at': now + self.ttl},
+                option=self.db_factory().write_option(last_update_time=snapshot.update_time),
+            )
+        except FailedPrecondition:
+            return False
+        return True
+
+    async def confirm_reply(self, user_id, chat_id):
+        """Ответ отправлен: закрепление больше не истекает"""
+        from firebase_admin import firestore
+
+        await asyncio.to_thread(self._claim(user_id, chat_id).update, {'expires_at': firestore.DELETE_FIELD})
+
+    async def release_reply(self, user_id, chat_id):
+        await asyncio.to_thread(self._claim(user_id, chat_id).delete)
+
+    def reclaim_replies(self, owns):
+        """Перехватывает истекшие закрепления аккаунтов, для которых owns(user_id) истинно.
+
+        Возвращает их документы: ответы из них нужно поставить в свою очередь.
+        """
+        reclaimed = []
+        for snapshot in self._collection('reply_claims').where('expires_at', '<', time.time()).stream():
+            claim = snapshot.to_dict()
+            if owns(claim['user_id']) and self._take_over(snapshot, claim['payload']):
+                reclaimed.append(claim)
+        return reclaimed
+
+    def purge_replies(self, before):
+        purged = 0
+        for doc in self._collection('reply_claims').where('claimed_at', '<', before).stream():
+            doc.reference.delete()
+            purged += 1
+        return purged
+
+
+class ShardCoordinator:
+    """Делит активные аккаунты между воркерами по кольцу живых воркеров.
+
+    Каждый воркер каждые heartbeat секунд (отдельной задачей, независимо
+    от длительности опроса) обновляет свой heartbeat и перечитывает состав;
+    аккаунт принадлежит воркеру, на которого он попадает в кольце.
+    Когда воркер появляется или перестает слать heartbeat (дольше ttl),
+    кольцо у всех пересчитывается и аккаунты перераспределяются сами.
+    """
+
+    def __init__(self, membership, worker_id=WORKER_ID, heartbeat=WORKER_HEARTBEAT, ttl=WORKER_TTL,
+                 clock=time.time):
+        self.membership = membership
+        self.worker_id = worker_id
+        self.heartbeat = heartbeat
+        self.ttl = ttl
+        self.clock = clock
+        self.ring = HashRing([worker_id])
+        self._refreshed_at = None
+        self.rebalances = 0
+
+    def refresh(self, force=False):
+        """Heartbeat и пересчет кольца не чаще heartbeat секунд. True, если состав изменился"""
+        now = self.clock()
+        if not force and self._refreshed_at is not None and now - self._refreshed_at < self.heartbeat:
+            return False
+        self._refreshed_at = now
+        try:
+            self.membership.heartbeat(self.worker_id, now)
+            workers = set(self.membership.live_workers(now - self.ttl))
+            self.membership.purge(now - self.ttl * 10)
+        except Exception as e:
+            # Без связи с реестром продолжаем со старым кольцом
+            logger.error("Shard membership refresh failed: %s", e)
+            return False
+        workers.add(self.worker_id)
+        if tuple(sorted(workers)) == self.ring.workers:
+            return False
+        logger.info("Shard ring changed: %s -> %s", self.ring.workers, tuple(sorted(workers)))
+        self.ring = HashRing(workers)
+        self.rebalances += 1
+        return True
+
+    def owns(self, user_id):
+        return self.ring.owner(user_id) == self.worker_id
+
+    def filter(self, users):
+        return [user_data for user_data in users if self.owns(user_data['user_id'])]
+
+    def leave(self):
+        """Уходим из реестра при остановке, чтобы остальные забрали аккаунты сразу, а не через ttl"""
+        try:
+            self.membership.leave(self.worker_id)
+        except Exception as e:
+            logger.error("Shard membership leave failed: %s", e)
+
+    def stats(self):
+        return {
+            'worker_id': self.worker_id,
+            'workers': len(self.ring.workers),
+            'rebalances': self.rebalances,
+        }
+
+
+def create_coordinator(bot, backend=SHARD_BACKEND):
+    """ShardCoordinator по SHARD_BACKEND или None, если шардирование выключено"""
+    if not backend:
+        return None
+    if backend == 'sqlite':
+        return ShardCoordinator(SqliteMembership(bot.sql))
+    if backend == 'firestore':
+        return ShardCoordinator(FirestoreMembership(lambda: bot.db))
+    raise ValueError(f"Unknown SHARD_BACKEND: {backend}")
+
+
+def create_chat_state(bot, backend=SHARD_BACKEND):
+    """Где лежат отметки чатов: в Firestore для воркеров на разных машинах, иначе в SQLite"""
+    if backend == 'firestore':
+        return FirestoreChatState(lambda: bot.db)
+    return SqliteChatState(bot.sql)
@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+import time
+
+# Где хранится состояние диалогов: 'sqlite' (один сервер) или 'firestore' (несколько экземпляров)
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite').lower()
+# Сколько секунд локальной копии можно верить, не перечитывая общее хранилище
+STATE_CACHE_TTL = float(os.getenv('STATE_CACHE_TTL', '1'))
+# Брошенная на полпути настройка ключей забывается через ONBOARDING_TTL секунд
+ONBOARDING_TTL = int(os.getenv('ONBOARDING_TTL', str(60 * 60)))
+STATE_PURGE_INTERVAL = 10 * 60
+
+_DELETED = object()
+
+
+class SqliteStateBackend:
+    """Состояние в таблице conversation_state локального SQLite"""
+
+    def __init__(self, database):
+        self.database = database
+
+    def get(self, kind, key):
+        row = self.database.get_state(kind, key)
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def save(self, rows, deleted):
+        self.database.save_states(
+            [(kind, key, json.dumps(value, ensure_ascii=False), updated_at) for kind, key, value, updated_at in rows],
+            deleted,
+        )
+
+    def purge(self, before):
+        return self.database.purge_states(before)
+
+
+class FirestoreStateBackend:
+    """Состояние в коллекции conversation_state Firestore, общей для всех экземпляров"""
+
+    def __init__(self, db_factory):
+        self.db_factory = db_factory
+
+    def _collection(self):
+        return self.db_factory().collection('conversation_state')
+
+    def get(self, kind, key):
+        doc = self._collection().document(f'{kind}:{key}').get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        return json.loads(data['data']), data['updated_at']
+
+    def save(self, rows, deleted):
+        collection = self._collection()
+        batch = self.db_factory().batch()
+        for kind, key, value, updated_at in rows:
+            batch.set(collection.document(f'{kind}:{key}'), {
+                'kind': kind,
+                'data': json.dumps(value, ensure_ascii=False),
+                'updated_at': updated_at,
+            })
+        for kind, key in deleted:
+            batch.delete(collection.document(f'{kind}:{key}'))
+        batch.commit()
+
+    def purge(self, before):
+        purged = 0
+        for doc in self._collection().where('updated_at', '<', before).stream():
+            doc.reference.delete()
+            purged += 1
+        return purged
+
+
+class StateStore:
+    """Кэш поверх backend с отложенной записью.
+
+    Чтение идет из локальной копии, если она моложе cache_ttl, иначе из
+    backend (так другой экземпляр видит свежие изменения). Записи копятся
+    и уходят в backend одной пачкой в flush() — по одному разу на апдейт.
+    Записи старше ttl считаются отсутствующими и удаляются в purge().
+    """
+
+    def __init__(self, backend, cache_ttl=STATE_CACHE_TTL, ttl=ONBOARDING_TTL, clock=time.time):
+        self.backend = backend
+        self.cache_ttl = cache_ttl
+        self.ttl = ttl
+        self.clock = clock
+        self._cache = {}  # (kind, key) -> (value, updated_at, fetched_at)
+        self._dirty = {}  # (kind, key) -> (value | _DELETED, updated_at)
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.flushes = 0
+
+    def get(self, kind, key, default=None):
+        now = self.clock()
+        item = (kind, str(key))
+        with self._lock:
+            dirty = self._dirty.get(item)
+            if dirty is not None:
+                value, _ = dirty
+                return default if value is _DELETED else value
+            cached = self._cache.get(item)
+        if cached is None or now - cached[2] >= self.cache_ttl:
+            self.reads += 1
+            stored = self.backend.get(kind, str(key))
+            value, updated_at = stored if stored else (None, 0)
+            cached = (value, updated_at, now)
+            with self._lock:
+                self._cache[item] = cached
+        value, updated_at, _ = cached
+        if value is None or now - updated_at >= self.ttl:
+            return default
+        return value
+
+    def set(self, kind, key, value):
+        now = self.clock()
+        item = (kind, str(key))
+        with self._lock:
+            self._cache[item] = (value, now, now)
+            self._dirty[item] = (value, now)
+
+    def delete(self, kind, key):
+        now = self.clock()
+        item = (kind, str(key))
+        with self._lock:
+            self._cache[item] = (None, 0, now)
+            self._dirty[item] = (_DELETED, now)
+
+    def flush(self):
+        """Записывает накопленные изменения одной пачкой. Возвращает их число"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+        rows = [(kind, key, value, updated_at)
+                for (kind, key), (value, updated_at) in dirty.items() if value is not _DELETED]
+        deleted = [(kind, key) for (kind, key), (value, _) in dirty.items() if value is _DELETED]
+        try:
+            self.backend.save(rows, deleted)
+        except Exception:
+            # Не теряем изменения: более новые записи за это время не перетираем
+            with self._lock:
+                for item, change in dirty.items():
+                    self._dirty.setdefault(item, change)
+            raise
+        self.flushes += 1
+        return len(dirty)
+
+    def purge(self):
+        """Удаляет записи брошенных диалогов и чистит локальный кэш"""
+        before = self.clock() - self.ttl
+        with self._lock:
+            self._cache = {item: cached for item, cached in self._cache.items() if cached[2] >= before}
+        return self.backend.purge(before)
+
+    def stats(self):
+        return {
+            'cached': len(self._cache),
+            'dirty': len(self._dirty),
+            'reads': self.reads,
+            'flushes': self.flushes,
+        }
+
+
+class OnboardingCredentials:
+    """Частично введенные ключи Avito (Client ID → Secret → User ID) в StateStore"""
+
+    kind = 'onboarding'
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, user_id) -> dict:
+        return dict(self.store.get(self.kind, user_id) or {})
+
+    def update(self, user_id, **fields):
+        credentials = self.get(user_id)
+        credentials.update(fields)
+        self.store.set(self.kind, user_id, credentials)
+        return credentials
+
+    def discard(self, user_id):
+        self.store.delete(self.kind, user_id)
+
+
+class ConversationStates:
+    """Текущий шаг диалога пользователя в StateStore, ключ как у ConversationHandler: (chat_id, user_id)"""
+
+    kind = 'conversation'
+
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def key(update):
+        return f'{update.effective_chat.id}:{update.effective_user.id}'
+
+    def get(self, update):
+        return self.store.get(self.kind, self.key(update))
+
+    def set(self, update, state):
+        """None или ConversationHandler.END (-1) завершают диалог"""
+        if state is None or state == -1:
+            self.store.delete(self.kind, self.key(update))
+        else:
+            self.store.set(self.kind, self.key(update), state)
+
+
+def create_state_store(bot, backend=STATE_BACKEND):
+    if backend == 'sqlite':
+        return StateStore(SqliteStateBackend(bot.sql))
+    if backend == 'firestore':
+        return StateStore(FirestoreStateBackend(lambda: bot.db))
+    raise ValueError(f"Unknown STATE_BACKEND: {backend}")
+
@@ -0,0 +1,568 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DB_PATH = os.getenv('DB_PATH', 'avito_bot.db')
+
+# Сколько новых ответов копится в памяти до записи в SQLite
+REPLIED_FLUSH_SIZE = 100
+
+# Настройки SQLite: WAL + synchronous=NORMAL убирают fsync на каждую запись,
+# cache_size в KiB (отрицательное значение), кэш подготовленных выражений
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', '20000'))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_CACHED_STATEMENTS = 256
+
+# Колонки, добавленные после создания таблиц: (таблица, колонка, определение)
+MIGRATIONS = [
+    ('users', 'blocked', 'INTEGER DEFAULT 0'),
+    ('qr_payments', 'check_attempts', 'INTEGER DEFAULT 0'),
+    ('qr_payments', 'next_check_at', 'REAL DEFAULT 0'),
+    ('chat_watermarks', 'resume_offset', 'INTEGER DEFAULT 0'),
+    ('chat_watermarks', 'pass_latest', 'INTEGER DEFAULT 0'),
+    ('chat_watermarks', 'resume_before', 'INTEGER DEFAULT 0'),
+    ('chat_watermarks', 'resume_chat', 'TEXT'),
+]
+# Индексы по колонкам из MIGRATIONS создаются после миграций
+MIGRATED_SCHEMA = '''
+    CREATE INDEX IF NOT EXISTS qr_payments_pending ON qr_payments (status, next_check_at);
+'''
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id TEXT PRIMARY KEY,
+        client_id TEXT,
+        client_secret TEXT,
+        avito_user_id TEXT,
+        template TEXT,
+        auto_reply_enabled INTEGER DEFAULT 0,
+        auto_reply_start_time INTEGER DEFAULT 0,
+        image_file_id TEXT,
+        notified_main_balance_200 INTEGER DEFAULT 0,
+        notified_advance_200 INTEGER DEFAULT 0,
+        notified_advance_100 INTEGER DEFAULT 0,
+        paid_accounts INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS replied_chats (
+        user_id TEXT,
+        chat_id TEXT,
+        replied_at INTEGER,
+        PRIMARY KEY (user_id, chat_id)
+    );
+    CREATE INDEX IF NOT EXISTS replied_chats_replied_at ON replied_chats (replied_at);
+    CREATE TABLE IF NOT EXISTS qr_payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        qrc_id TEXT UNIQUE,
+        amount INTEGER,
+        accounts_count INTEGER,
+        status TEXT DEFAULT 'pending',
+        created_at INTEGER DEFAULT (strftime('%s','now')),
+        paid_at INTEGER,
+        check_attempts INTEGER DEFAULT 0,
+        next_check_at REAL DEFAULT 0,
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    );
+    CREATE TABLE IF NOT EXISTS reply_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        chat_id TEXT,
+        payload TEXT,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        created_at REAL,
+        available_at REAL,
+        finished_at REAL,
+        last_error TEXT,
+        UNIQUE (user_id, chat_id)
+    );
+    CREATE INDEX IF NOT EXISTS reply_queue_status_available
+        ON reply_queue (status, available_at);
+    CREATE TABLE IF NOT EXISTS chat_watermarks (
+        user_id TEXT PRIMARY KEY,
+        last_message_created INTEGER,
+        resume_offset INTEGER DEFAULT 0,
+        pass_latest INTEGER DEFAULT 0,
+        resume_before INTEGER DEFAULT 0,
+        resume_chat TEXT
+    );
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        name TEXT PRIMARY KEY,
+        last_user_id TEXT,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        started_at INTEGER,
+        finished_at INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS image_assets (
+        avito_user_id TEXT,
+        content_hash TEXT,
+        image_id TEXT,
+        uploaded_at INTEGER,
+        PRIMARY KEY (avito_user_id, content_hash)
+    );
+    CREATE TABLE IF NOT EXISTS conversation_state (
+        kind TEXT,
+        key TEXT,
+        data TEXT,
+        updated_at REAL,
+        PRIMARY KEY (kind, key)
+    );
+    CREATE INDEX IF NOT EXISTS conversation_state_updated_at ON conversation_state (updated_at);
+    CREATE TABLE IF NOT EXISTS workers (
+        worker_id TEXT PRIMARY KEY,
+        started_at REAL,
+        heartbeat_at REAL
+    );
+'''
+
+
+class Database:
+    """Долгоживущее соединение с avito_bot.db.
+
+    Все обращения к таблицам (users, replied_chats, qr_payments и др.) идут через этот класс,
+    чтобы не открывать соединение и не делать fsync на каждую строку.
+    Соединение работает в autocommit-режиме, транзакции открываются явно
+    через transaction().
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            with self._lock:
+                if self._conn is None:
+                    self._conn = self._connect()
+        return self._conn
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=SQLITE_CACHED_STATEMENTS,
+        )
+        # Для новой базы: освобожденные страницы возвращаются через incremental_vacuum.
+        # Должно идти до journal_mode=WAL и схемы: они записывают заголовок файла,
+        # после чего режим меняется только полным VACUUM (см. retention.py --vacuum)
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+        conn.executescript(SCHEMA)
+        for table, column, definition in MIGRATIONS:
+            columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+            if column not in columns:
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        conn.executescript(MIGRATED_SCHEMA)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT, при исключении ROLLBACK"""
+        with self._lock:
+            conn = self.conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+
+    def execute(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        with self.transaction() as conn:
+            conn.executemany(sql, rows)
+
+    def fetchone(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # --- replied_chats ---
+
+    def load_replied_chats(self):
+        return self.fetchall('SELECT user_id, chat_id FROM replied_chats')
+
+    def save_replied_chats(self, rows):
+        self.executemany('''
+            INSERT OR REPLACE INTO replied_chats (user_id, chat_id, replied_at)
+            VALUES (?, ?, ?)
+        ''', rows)
+
+    def prune_replied_chats(self, before, limit):
+        """Удаляет до limit ответов старше before (по индексу replied_at). Возвращает удаленные пары"""
+        with self.transaction() as conn:
+            return conn.execute('''
+                DELETE FROM replied_chats
+                WHERE rowid IN (
+                    SELECT rowid FROM replied_chats WHERE replied_at < ? LIMIT ?
+                )
+                RETURNING user_id, chat_id
+            ''', (before, limit)).fetchall()
+
+    def count_replied_chats(self):
+        return self.fetchone('SELECT COUNT(*) FROM replied_chats')[0]
+
+    # --- обслуживание ---
+
+    def size_stats(self):
+        """Размер файла базы в страницах и байтах, включая свободные страницы"""
+        page_size = self.fetchone('PRAGMA page_size')[0]
+        page_count = self.fetchone('PRAGMA page_count')[0]
+        freelist = self.fetchone('PRAGMA freelist_count')[0]
+        return {
+            'page_size': page_size,
+            'pages': page_count,
+            'free_pages': freelist,
+            'bytes': page_size * page_count,
+            'auto_vacuum': self.fetchone('PRAGMA auto_vacuum')[0],
+        }
+
+    def incremental_vacuum(self, pages):
+        """Возвращает файловой системе до pages свободных страниц"""
+        with self._lock:
+            # Через execute() модуль sqlite3 делает один шаг прагмы и освобождает
+            # одну страницу; executescript прогоняет ее до конца
+            self.conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+
+    def vacuum(self):
+        self.execute('VACUUM')
+
+    def analyze(self, table=None):
+        self.execute(f'ANALYZE {table}' if table else 'ANALYZE')
+
+    # --- users ---
+
+    def get_paid_accounts(self, user_id):
+        row = self.fetchone('SELECT paid_accounts FROM users WHERE user_id = ?', (user_id,))
+        return row[0] if row and row[0] else 0
+
+    def get_user_ids_after(self, last_user_id, limit):
+        """Следующая порция получателей рассылки по user_id (keyset-пагинация), без заблокировавших"""
+        rows = self.fetchall('''
+            SELECT user_id FROM users
+            WHERE user_id > ? AND COALESCE(blocked, 0) = 0
+            ORDER BY user_id
+            LIMIT ?
+        ''', (last_user_id or '', limit))
+        return [row[0] for row in rows]
+
+    def mark_users_blocked(self, user_ids):
+        self.executemany('UPDATE users SET blocked = 1 WHERE user_id = ?', [(user_id,) for user_id in user_ids])
+
+    # --- broadcasts ---
+
+    def get_broadcast(self, name):
+        row = self.fetchone('''
+            SELECT last_user_id, sent, failed, blocked, started_at, finished_at
+            FROM broadcasts WHERE name = ?
+        ''', (name,))
+        if not row:
+            return None
+        keys = ('last_user_id', 'sent', 'failed', 'blocked', 'started_at', 'finished_at')
+        return dict(zip(keys, row))
+
+    def save_broadcast(self, name, state):
+        self.execute('''
+            INSERT OR REPLACE INTO broadcasts
+            (name, last_user_id, sent, failed, blocked, started_at, finished_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (name, state['last_user_id'], state['sent'], state['failed'], state['blocked'],
+              state['started_at'], state['finished_at']))
+
+    # --- chat_watermarks ---
+
+    def get_chat_cursor(self, user_id):
+        """(watermark, resume_offset, pass_latest, resume_before, resume_chat) аккаунта.
+
+        Пока проход по непрочитанным чатам не дочитан: resume_offset — с какого
+        offset продолжать, pass_latest — самое свежее сообщение прохода,
+        resume_before — самое старое уже прочитанное (все, что новее, обработано),
+        resume_chat — id последнего прочитанного чата, по которому проверяется,
+        не сдвинулся ли список.
+        """
+        row = self.fetchone(
+            '''SELECT last_message_created, resume_offset, pass_latest, resume_before, resume_chat
+               FROM chat_watermarks WHERE user_id = ?''',
+            (user_id,)
+        )
+        if not row:
+            return 0, 0, 0, 0, None
+        return row[0] or 0, row[1] or 0, row[2] or 0, row[3] or 0, row[4]
+
+    def save_chat_cursor(self, user_id, watermark, resume_offset=0, pass_latest=0,
+                         resume_before=0, resume_chat=None):
+        self.execute('''
+            INSERT INTO chat_watermarks
+            (user_id, last_message_created, resume_offset, pass_latest, resume_before, resume_chat)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (user_id) DO UPDATE
+            SET last_message_created = MAX(last_message_created, excluded.last_message_created),
+                resume_offset = excluded.resume_offset,
+                pass_latest = excluded.pass_latest,
+                resume_before = excluded.resume_before,
+                resume_chat = excluded.resume_chat
+        ''', (user_id, watermark, resume_offset, pass_latest, resume_before, resume_chat))
+
+    # --- image_assets ---
+
+    def get_image_asset(self, avito_user_id, content_hash):
+        row = self.fetchone(
+            'SELECT image_id FROM image_assets WHERE avito_user_id = ? AND content_hash = ?',
+            (avito_user_id, content_hash)
+        )
+        return row[0] if row else None
+
+    def save_image_asset(self, avito_user_id, content_hash, image_id):
+        self.execute('''
+            INSERT OR REPLACE INTO image_assets (avito_user_id, content_hash, image_id, uploaded_at)
+            VALUES (?, ?, ?, ?)
+        ''', (avito_user_id, content_hash, image_id, int(time.time())))
+
+    def delete_image_asset(self, avito_user_id, content_hash):
+        self.execute(
+            'DELETE FROM image_assets WHERE avito_user_id = ? AND content_hash = ?',
+            (avito_user_id, content_hash)
+        )
+
+    # --- conversation_state ---
+
+    def get_state(self, kind, key):
+        """(data, updated_at) записи состояния или None"""
+        return self.fetchone(
+            'SELECT data, updated_at FROM conversation_state WHERE kind = ? AND key = ?', (kind, key)
+        )
+
+    def save_states(self, rows, deleted):
+        """rows — (kind, key, data, updated_at), deleted — (kind, key); одной транзакцией"""
+        with self.transaction() as conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO conversation_state (kind, key, data, updated_at)
+                VALUES (?, ?, ?, ?)
+            ''', rows)
+            conn.executemany('DELETE FROM conversation_state WHERE kind = ? AND key = ?', deleted)
+
+    def purge_states(self, before):
+        cursor = self.execute('DELETE FROM conversation_state WHERE updated_at < ?', (before,))
+        return cursor.rowcount
+
+    # --- workers ---
+
+    def heartbeat_worker(self, worker_id, now):
+        self.execute('''
+            INSERT INTO workers (worker_id, started_at, heartbeat_at) VALUES (?, ?, ?)
+            ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at
+        ''', (worker_id, now, now))
+
+    def get_live_workers(self, since):
+        rows = self.fetchall('SELECT worker_id FROM workers WHERE heartbeat_at >= ?', (since,))
+        return [row[0] for row in rows]
+
+    def remove_worker(self, worker_id):
+        self.execute('DELETE FROM workers WHERE worker_id = ?', (worker_id,))
+
+    def purge_dead_workers(self, before):
+        self.execute('DELETE FROM workers WHERE heartbeat_at < ?', (before,))
+
+    # --- qr_payments ---
+
+    def create_qr_payment(self, user_id, qrc_id, amount, accounts_count):
+        with self.transaction() as conn:
+            conn.execute('''
+                INSERT INTO qr_payments
+                (user_id, qrc_id, amount, accounts_count, status)
+                VALUES (?, ?, ?, ?, 'pending')
+            ''', (user_id, qrc_id, amount, accounts_count))
+
+    def get_due_payments(self, now, after_id, limit):
+        """Следующая порция ожидающих платежей, которым пора проверить статус (keyset по id)"""
+        rows = self.fetchall('''
+            SELECT id, user_id, qrc_id, created_at, check_attempts FROM qr_payments
+            WHERE status = 'pending' AND next_check_at <= ? AND id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (now, after_id, limit))
+        keys = ('id', 'user_id', 'qrc_id', 'created_at', 'check_attempts')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def reschedule_payment_check(self, qrc_id, next_check_at):
+        self.execute('''
+            UPDATE qr_payments SET check_attempts = check_attempts + 1, next_check_at = ?
+            WHERE qrc_id = ? AND status = 'pending'
+        ''', (next_check_at, qrc_id))
+
+    def expire_qr_payments(self, created_before):
+        """Переводит в expired неоплаченные платежи, чей QR-код уже недействителен"""
+        cursor = self.execute('''
+            UPDATE qr_payments SET status = 'expired'
+            WHERE status = 'pending' AND created_at < ?
+        ''', (created_before,))
+        return cursor.rowcount
+
+    def get_qr_payment_status(self, qrc_id, user_id):
+        """Статус платежа пользователя; None, если платежа нет или он чужой"""
+        row = self.fetchone('SELECT status FROM qr_payments WHERE qrc_id = ? AND user_id = ?', (qrc_id, user_id))
+        return row[0] if row else None
+
+    def complete_qr_payment(self, user_id, qrc_id):
+        """Помечает платеж оплаченным и начисляет аккаунты. Возвращает accounts_count или None"""
+        with self.transaction() as conn:
+            row = conn.execute('''
+                UPDATE qr_payments
+                SET status = 'succeeded', paid_at = strftime('%s','now')
+                WHERE qrc_id = ? AND user_id = ? AND status = 'pending'
+                RETURNING accounts_count
+            ''', (qrc_id, user_id)).fetchone()
+            if not row:
+                return None
+
+            conn.execute('''
+                UPDATE users
+                SET paid_accounts = paid_accounts + ?
+                WHERE user_id = ?
+            ''', (row[0], user_id))
+            return row[0]
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(db_path=DB_PATH) -> Database:
+    """Общий экземпляр Database для файла базы"""
+    with _databases_lock:
+        if db_path not in _databases:
+            _databases[db_path] = Database(db_path)
+        return _databases[db_path]
+
+
+def close_databases():
+    with _databases_lock:
+        for database in _databases.values():
+            database.close()
+
+
+class ImageAssetCache:
+    """image_id картинок, уже загруженных в Avito, по (аккаунт, хэш содержимого).
+
+    Картинка автоответа загружается через uploadImages один раз на аккаунт,
+    дальше ее image_id переиспользуется для всех чатов. Смена картинки
+    меняет хэш, поэтому старый image_id просто перестает находиться.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._image_ids = {}
+
+    @staticmethod
+    def content_hash(content):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        return hashlib.sha256(content).hexdigest()
+
+    def get(self, avito_user_id, content_hash):
+        key = (str(avito_user_id), content_hash)
+        if key not in self._image_ids:
+            self._image_ids[key] = self.database.get_image_asset(*key)
+        return self._image_ids[key]
+
+    def put(self, avito_user_id, content_hash, image_id):
+        key = (str(avito_user_id), content_hash)
+        self._image_ids[key] = image_id
+        self.database.save_image_asset(*key, image_id)
+
+    def invalidate(self, avito_user_id, content_hash):
+        key = (str(avito_user_id), content_hash)
+        self._image_ids.pop(key, None)
+        self.database.delete_image_asset(*key)
+
+
+class RepliedChatIndex:
+    """Индекс чатов, на которые уже отправлен автоответ.
+
+    Все пары (user_id, chat_id) из replied_chats один раз загружаются в память,
+    поэтому проверка "уже отвечали?" не ходит в SQLite. Новые ответы попадают
+    в буфер и записываются пачкой в одной транзакции (write-behind).
+    """
+
+    def __init__(self, database, flush_size=REPLIED_FLUSH_SIZE):
+        self.database = database
+        self.flush_size = flush_size
+        self._replied = set()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def load(self):
+        rows = self.database.load_replied_chats()
+        with self._lock:
+            self._replied.update((str(user_id), str(chat_id)) for user_id, chat_id in rows)
+            self._loaded = True
+
+    def contains(self, user_id, chat_id) -> bool:
+        if not self._loaded:
+            self.load()
+        return (str(user_id), str(chat_id)) in self._replied
+
+    def add(self, user_id, chat_id):
+        key = (str(user_id), str(chat_id))
+        with self._lock:
+            self._replied.add(key)
+            self._pending.append(key + (int(time.time()),))
+            should_flush = len(self._pending) >= self.flush_size
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """Записывает накопленные ответы в replied_chats одной транзакцией"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return 0
+
+        try:
+            self.database.save_replied_chats(pending)
+        except Exception:
+            # Возвращаем записи в буфер, чтобы не потерять их до следующей попытки
+            with self._lock:
+                self._pending = pending + self._pending
+            raise
+        return len(pending)
+
+    def discard(self, keys):
+        """Убирает из памяти пары, удаленные из replied_chats при очистке"""
+        with self._lock:
+            self._replied.difference_update((str(user_id), str(chat_id)) for user_id, chat_id in keys)
+
+    def __len__(self):
+        return len(self._replied)
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
@@ -0,0 +1,82 @@
+"""Локальная замена Avito: шлет поддельные события мессенджера на webhook бота.
+
+    python tools/fake_avito_events.py --url http://127.0.0.1:8081/avito/webhook/<secret> \\
+        --account 123456 --chats 50 --duplicates 1
+
+Каждое событие можно отправить несколько раз (--duplicates), чтобы
+проверить, что бот отвечает в чат только один раз.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+import aiohttp
+
+
+def make_event(account_id, chat_id, author_id):
+    now = int(time.time())
+    return {
+        'id': str(uuid.uuid4()),
+        'version': 'v3.0.0',
+        'timestamp': now,
+        'payload': {
+            'type': 'message',
+            'value': {
+                'id': str(uuid.uuid4()),
+                'chat_id': chat_id,
+                'user_id': account_id,
+                'author_id': author_id,
+                'created': now,
+                'type': 'text',
+                'chat_type': 'u2i',
+                'content': {'text': 'Здравствуйте, товар еще продается?'},
+            },
+        },
+    }
+
+
+async def send_events(url, account_id, chats, duplicates, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses = {}
+    latencies = []
+
+    async def post(session, event):
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.post(url, json=event) as response:
+                await response.read()
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    events = [
+        make_event(account_id, f'fake-chat-{i}', author_id=10_000_000 + i)
+        for i in range(chats)
+    ]
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(
+            post(session, event)
+            for event in events
+            for _ in range(1 + duplicates)
+        ))
+
+    latencies.sort()
+    print(f"Отправлено событий: {sum(statuses.values())}, статусы: {statuses}")
+    if latencies:
+        print(f"Ответ webhook: p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+              f"max {latencies[-1] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', required=True)
+    parser.add_argument('--account', type=int, required=True, help='avito_user_id аккаунта')
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--duplicates', type=int, default=0, help='повторных доставок на событие')
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(send_events(args.url, args.account, args.chats, args.duplicates, args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
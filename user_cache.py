@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))
+
+_MISSING = object()
+
+
+class UserCache:
+    """Ограниченный LRU/TTL-кэш документов users из Firestore.
+
+    Хранит и отсутствующие документы (None), чтобы нажатия кнопок
+    незарегистрированными пользователями тоже не ходили в Firestore.
+    Наружу всегда отдаются копии, поэтому правка user_data в обработчике
+    не меняет кэш до save_user.
+    """
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (data, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        """Возвращает копию документа, None для отсутствующего или _MISSING при промахе"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return _MISSING
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return dict(entry[0]) if entry[0] is not None else None
+
+    def put(self, user_id, data):
+        with self._lock:
+            self._entries[user_id] = (dict(data) if data is not None else None,
+                                      time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def merge(self, user_id, data):
+        """Write-through для set(..., merge=True): дополняет закэшированный документ"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            # Полного документа в кэше нет, частичный класть нельзя
+            self.invalidate(user_id)
+            return
+        merged = dict(entry[0] or {})
+        merged.update(data)
+        self.put(user_id, merged)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def on_snapshot(self, col_snapshot, changes, read_time):
+        """Колбэк для Firestore on_snapshot.
+
+        Документы, измененные извне, сразу обновляются из снимка (удаленные
+        запоминаются как None); незакэшированные документы не добавляются.
+        """
+        for change in changes:
+            user_id = change.document.id
+            with self._lock:
+                cached = user_id in self._entries
+            if not cached:
+                continue
+            self.invalidations += 1
+            if change.type.name == 'REMOVED':
+                self.put(user_id, None)
+            else:
+                self.put(user_id, change.document.to_dict())
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+def is_miss(value):
+    return value is _MISSING
@@ -0,0 +1,47 @@
+# Firestore допускает не больше 500 операций в одном batch
+FIRESTORE_BATCH_LIMIT = 500
+
+
+class UserUpdateBatch:
+    """Копит измененные поля документов users и записывает их пачками.
+
+    Несколько изменений одного пользователя за проход сливаются в одну
+    операцию set(..., merge=True), а в Firestore пишутся только сами поля,
+    без перезаписи всего документа с ключами доступа.
+    """
+
+    def __init__(self, db, cache=None, batch_limit=FIRESTORE_BATCH_LIMIT):
+        self.db = db
+        self.cache = cache
+        self.batch_limit = batch_limit
+        self._dirty = {}  # user_id -> {field: value}
+
+    def set(self, user_id, field, value):
+        self._dirty.setdefault(user_id, {})[field] = value
+
+    def update(self, user_id, fields: dict):
+        self._dirty.setdefault(user_id, {}).update(fields)
+
+    def __len__(self):
+        return len(self._dirty)
+
+    def commit(self):
+        """Записывает накопленные изменения. Возвращает число выполненных batch.commit()"""
+        items = list(self._dirty.items())
+        self._dirty = {}
+        commits = 0
+        collection = self.db.collection('users')
+
+        for start in range(0, len(items), self.batch_limit):
+            chunk = items[start:start + self.batch_limit]
+            batch = self.db.batch()
+            for user_id, fields in chunk:
+                batch.set(collection.document(user_id), fields, merge=True)
+            batch.commit()
+            commits += 1
+
+            if self.cache is not None:
+                for user_id, fields in chunk:
+                    self.cache.merge(user_id, fields)
+
+        return commits
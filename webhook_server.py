@@ -0,0 +1,123 @@
+import asyncio
+import hmac
+import logging
+import os
+
+from aiohttp import web
+from telegram import Update
+
+from bot import get_bot, build_application
+from avito_webhook import AvitoWebhookReceiver, webhook_enabled
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный адрес сервера для setWebhook
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Запускать ли периодические задачи (опрос Avito, балансы) внутри webhook-сервера
+WEBHOOK_JOBS = os.getenv('WEBHOOK_JOBS', '1') == '1'
+
+_application = None
+_application_lock = None
+
+
+async def get_application(with_jobs=False):
+    """Один инициализированный Application на процесс.
+
+    Используется serverless-обработчиками в api/: пока экземпляр функции
+    "теплый", Application, ConversationHandler и AvitoBot не пересоздаются.
+    """
+    global _application, _application_lock
+    if _application_lock is None:
+        _application_lock = asyncio.Lock()
+    async with _application_lock:
+        if _application is None:
+            application = build_application(get_bot(), with_jobs=with_jobs)
+            await application.initialize()
+            _application = application
+    return _application
+
+
+async def process_update_json(data):
+    application = await get_application()
+    await application.process_update(Update.de_json(data, application.bot))
+
+
+async def handle_update(request):
+    if WEBHOOK_SECRET:
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=403)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+
+    application = request.app['application']
+    # Отвечаем Telegram сразу, обработка идет в цикле Application
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return web.Response(text='OK')
+
+
+async def handle_health(request):
+    return web.Response(text='OK')
+
+
+async def on_startup(app):
+    application = build_application(get_bot(), with_jobs=WEBHOOK_JOBS,
+                                    avito_webhook_server=False, metrics_server=False)
+    await application.initialize()
+    if WEBHOOK_URL:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    await application.start()
+    # post_init вызывается только из run_polling/run_webhook: запускаем отправку ответов вручную
+    if application.post_init:
+        await application.post_init(application)
+    app['application'] = application
+    if 'avito_webhook' in app:
+        app['avito_webhook'].start_subscriptions()
+    logger.info("Webhook server started on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+
+async def on_cleanup(app):
+    if 'avito_webhook' in app:
+        await app['avito_webhook'].stop()
+    application = app['application']
+    await application.stop()
+    await application.shutdown()
+    # post_shutdown вызывается только из run_polling/run_webhook, поэтому вручную
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.router.add_get('/healthz', handle_health)
+    metrics.add_routes(app)
+    if webhook_enabled():
+        # События мессенджера Avito принимаются тем же сервером
+        receiver = AvitoWebhookReceiver(get_bot())
+        receiver.add_routes(app)
+        app['avito_webhook'] = receiver
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def main():
+    if os.getenv('USER_CACHE_LISTEN', '1') == '1':
+        get_bot().watch_users()
+    web.run_app(create_app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+
+
+if __name__ == '__main__':
+    main()